@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+benchmark.py -- compare serial and tasklet-based ConferenceApi read paths
+    against the local datastore stub
+
+Run with the App Engine SDK on the path, e.g.:
+
+    PYTHONPATH=$SDK:$SDK/lib/yaml/lib:lib python benchmark.py
+
+Each scenario is run with the old serial implementation and the current
+endpoint; the table shows mean wall time and datastore RPCs per call.
+No results have been recorded yet: the stub answers in-process, so its
+wall times say little about production latency, and the RPC counts only
+show where gets are batched. Latency gains should be measured against
+dev_appserver or a deployed version before being relied on.
+
+"""
+
+import argparse
+import time as clock
+from datetime import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from protorpc import message_types
+
+from conference import ConferenceApi
+from conference import CONF_GET_REQUEST
+from conference import SESS_LIST_REQUEST
+from models import Conference
+from models import Profile
+from models import Session
+
+RPC_COUNT = [0]
+
+
+def countDatastoreRpcs(service, call, request, response, rpc=None):
+    if service == 'datastore_v3':
+        RPC_COUNT[0] += 1
+
+
+def seed(sessionsPerConference):
+    """Create one organizer with a conference stored the legacy way (no
+    denormalized display name) and some sessions."""
+    p_key = Profile(id='organizer@example.com',
+                    displayName='Organizer').put()
+    c_key = Conference(parent=p_key, name='Bench Conference',
+                       organizerUserId=p_key.id(), maxAttendees=100,
+                       seatsAvailable=100).put()
+    sessions = []
+    for i in range(sessionsPerConference):
+        sessions.append(Session(parent=c_key, name='Session %d' % i,
+                                typeOfSession='Talk' if i % 3 else 'Workshop',
+                                time=time(9 + i % 12)))
+    ndb.put_multi(sessions)
+    return c_key
+
+
+# - - - serial implementations, as before the tasklet rewrite - - - - - - -
+
+def serialGetConference(api, wsck):
+    conf = ndb.Key(urlsafe=wsck).get()
+    prof = conf.key.parent().get()
+    return api._copyConferenceToForm(conf, prof.displayName)
+
+
+def serialGetConferenceSessions(api, wsck):
+    conf = ndb.Key(urlsafe=wsck).get()
+    assert conf
+    return [api._copySessionToForm(sess)
+            for sess in Session.query(ancestor=ndb.Key(urlsafe=wsck))]
+
+
+def serialNoWorkshopsOrLateNights(api):
+    q1 = Session.query(Session.typeOfSession != 'Workshop').fetch(
+        keys_only=True)
+    q2 = Session.query(Session.time < time(19)).fetch(keys_only=True)
+    return ndb.get_multi(set(q1).intersection(q2))
+
+
+def measure(fn, iterations):
+    ctx = ndb.get_context()
+    RPC_COUNT[0] = 0
+    start = clock.time()
+    for _ in range(iterations):
+        ctx.clear_cache()
+        fn()
+    elapsed = clock.time() - start
+    return elapsed / iterations * 1000, float(RPC_COUNT[0]) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=30)
+    args = parser.parse_args()
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub()
+    ctx = ndb.get_context()
+    ctx.set_cache_policy(False)
+    ctx.set_memcache_policy(False)
+
+    hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+    hooks.Append('count', countDatastoreRpcs)
+
+    api = ConferenceApi()
+    wsck = seed(args.sessions).urlsafe()
+    request = CONF_GET_REQUEST.combined_message_class(inputString=wsck)
+    sessRequest = SESS_LIST_REQUEST.combined_message_class(inputString=wsck)
+
+    scenarios = [
+        ('getConference',
+         lambda: serialGetConference(api, wsck),
+         lambda: api.getConference(request)),
+        ('getConferenceSessions',
+         lambda: serialGetConferenceSessions(api, wsck),
+         lambda: api.getConferenceSessions(sessRequest)),
+        ('query_noWorkshopsOrLateNights',
+         lambda: serialNoWorkshopsOrLateNights(api),
+         lambda: api.query_noWorkshopsOrLateNights(
+             message_types.VoidMessage())),
+    ]
+
+    print('%-32s %12s %12s %10s %10s' % ('scenario', 'serial ms',
+                                         'tasklet ms', 'serial rpc',
+                                         'tasklet rpc'))
+    for name, serial, tasklet in scenarios:
+        serialMs, serialRpcs = measure(serial, args.iterations)
+        taskletMs, taskletRpcs = measure(tasklet, args.iterations)
+        print('%-32s %12.2f %12.2f %10.1f %10.1f' % (
+            name, serialMs, taskletMs, serialRpcs, taskletRpcs))
+
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
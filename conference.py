@@ -12,23 +12,35 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 from datetime import datetime
+from datetime import timedelta
 from datetime import date
 from datetime import time
+import csv
+import hashlib
+import io
+import json
+import operator
+import time as clock
 
 import endpoints
 from dateutil.parser import parse
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
 from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import ProfileForms
 from models import StringMessage
 from models import BooleanMessage
 from models import Session
@@ -37,24 +49,95 @@ from models import SessionForms
 from models import Speaker
 from models import SpeakerForm
 from models import Conference
+from models import Banner
+from models import SeatShard
+from models import SeatAvailabilityForm
+from models import SeatAvailabilityForms
+from models import Registration
+from models import Attendance
+from models import RegistrationRequest
+from models import Export
+from models import GroupRegistrationForm
+from models import GroupRegistrationResult
+from models import ExportChunk
+from models import IdempotencyRecord
+from models import RegistrationStatus
+from models import RegistrationTicketForm
 from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForms
+from models import ConferenceResult
+from models import ConferenceResults
 from models import TeeShirtSize
+from models import TransactionStatsForm
+from models import TransactionStatsForms
+from models import getConferenceGeneration
+from models import MEMCACHE_CONF_VERSION_KEY
+from models import MEMCACHE_CREATED_KEY
+from models import MEMCACHE_SEAT_SNAPSHOT_KEY
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
+from utils import getOrCompute
+from utils import getTransactionStats
+from utils import transactional
 from utils import getUserId
+from utils import LocalCache
+from utils import readThrough
+from utils import getReplicated
+from utils import setReplicated
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+# Was "RECENT_ANNOUNCEMENTS", which held the formatted string. Renamed as
+# the value is now a {websafeKey: name} set that the old one can't be read
+# as; the old entry just expires and the cron job rebuilds the new one.
+MEMCACHE_ANNOUNCEMENTS_KEY = "NEARLY_SOLD_OUT"
 MEMCACHE_FEATURED_KEY = "FEATURED_SPEAKER"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+ANNOUNCEMENT_THRESHOLD = 5  # seats left for a conference to be announced
+ANNOUNCEMENT_CAS_ATTEMPTS = 10
+MEMCACHE_BANNER_VERSION_KEY = "BANNER_VERSION:%s"
+BANNER_LOCAL_TTL = 10  # seconds an instance serves a banner unchecked
+BANNER_CACHE = LocalCache()
+MEMCACHE_QUERY_KEY = "CONFERENCE_QUERY:%s:%s"
+QUERY_CACHE_TTL = 10 * 60
+VERSION_CACHE_TTL = 60 * 60
+CREATED_CACHE_TTL = 60 * 60
+MEMCACHE_SEATS_KEY = "SEATS_AVAILABLE:%s"
+SEATS_CACHE_TTL = 5 * 60
+NUM_SEAT_SHARDS = 20  # with the Conference, within the 25 group xg limit
+SEAT_FOLD_INTERVAL = 60
+REGISTRATION_QUEUE = 'registrations'
+REGISTRATION_BATCH = 100  # Registrations under one SeatShard per commit
+MIGRATION_BATCH = 50
+REFILL_ATTEMPTS = 3
+MAX_GROUP_SIZE = 50
+REGISTRATION_LEASE_MAX = 100
+REGISTRATION_LEASE_SECONDS = 60
+REGISTRATION_TRIGGER_INTERVAL = 2
+MAX_PAGE_SIZE = 100
+ORGANIZER_UPDATE_BATCH = 100
+ARCHIVE_BATCH = 100
+MAX_BATCH_SIZE = 100
+MAX_TASKS_PER_ADD = 100  # taskqueue.Queue.add() limit
+PLANNER_COUNT_LIMIT = 1000
+PLANNER_DRIVER_LIMIT = 200
+EXPORT_BATCH = 500
+EXPORT_TASK_SECONDS = 5 * 60  # well inside the 10 minute task deadline
+EXPORT_COLUMNS = {
+    'attendees': ('userId', 'displayName', 'mainEmail', 'teeShirtSize'),
+    'sessions': ('websafeKey', 'name', 'speaker', 'typeOfSession', 'date',
+                 'time', 'duration', 'highlights'),
+}
+EXPORT_FORMATS = ('csv', 'jsonl')
+IDEMPOTENCY_TTL = 24 * 60 * 60
+IDEMPOTENCY_PENDING_SECONDS = 60  # claim held while the call runs
+IDEMPOTENCY_PURGE_BATCH = 500
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -73,6 +156,15 @@ OPERATORS = {
     'NE': '!='
 }
 
+FILTER_OPS = {
+    '=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne
+}
+
 FIELDS = {
     'CITY': 'city',
     'TOPIC': 'topics',
@@ -80,6 +172,10 @@ FIELDS = {
     'MAX_ATTENDEES': 'maxAttendees',
 }
 
+# Equalities on a repeated property may be met by different values, so they
+# can't be merged or checked against the other predicates on that field.
+REPEATED_FIELDS = ('topics', )
+
 # The Udacity evaluator suggested creating a more descriptive name for
 # inputString. But I have abstracted all of the Get or Delete requests into a
 # single ResourceContainer, so per-endpoint naming is not possible.
@@ -88,14 +184,61 @@ GET_OR_DELETE_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     inputString=messages.StringField(1), )
 
+CONF_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    inputString=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2), )
+
+CONF_CREATE_REQUEST = endpoints.ResourceContainer(
+    ConferenceForm,
+    idempotencyKey=messages.StringField(1), )
+
+IDEMPOTENT_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    inputString=messages.StringField(1),
+    idempotencyKey=messages.StringField(2), )
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     inputString=messages.StringField(1), )
 
 SESS_POST_REQUEST = endpoints.ResourceContainer(
     SessionForm,
+    inputString=messages.StringField(1),
+    idempotencyKey=messages.StringField(2), )
+
+FIELDS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1, repeated=True), )
+
+CONF_KEYS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeKeys=messages.StringField(1, repeated=True),
+    fields=messages.StringField(2, repeated=True), )
+
+SESS_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    inputString=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True), )
+
+ROSTER_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    inputString=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3), )
+
+GROUP_REGISTRATION_REQUEST = endpoints.ResourceContainer(
+    GroupRegistrationForm,
     inputString=messages.StringField(1), )
 
+SEATS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeKeys=messages.StringField(1, repeated=True), )
+
+REGISTRATION_STATUS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ticket=messages.StringField(1), )
+
 GET_CONF_SESS_BY_TYPE_REQUEST = endpoints.ResourceContainer(
     wsck=messages.StringField(1),
     sessType=messages.StringField(2), )
@@ -114,12 +257,153 @@ GET_CONF_SESS_BY_TYPE_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+    # - - - Keys - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _keyFromWebsafe(websafeKey, kind):
+        """Return the key a websafe string encodes, or None if it is
+        malformed or not a key of the given model class."""
+        try:
+            key = ndb.Key(urlsafe=websafeKey)
+        except (ProtocolBufferDecodeError, TypeError,
+                datastore_errors.BadValueError):
+            return None
+        return key if key.kind() == kind._get_kind() else None
+
+    # - - - Idempotency - - - - - - - - - - - - - - - - - - - -
+
+    # Clients may send an idempotencyKey with a mutating call. The first
+    # call claims the key and stores its response; a retry with the same
+    # key gets the stored response back instead of writing again.
+    # createConference writes its record in the same transaction as the
+    # conference instead, so a crash can't leave one without the other.
+
+    @staticmethod
+    @transactional('claimIdempotencyKey')
+    def _claimIdempotencyKey(i_key):
+        """Claim an idempotency key unless a live record holds it. Returns
+        the record and whether this call claimed it."""
+        now = datetime.now()
+        record = i_key.get()
+        if record and record.expires > now:
+            return record, False
+        record = IdempotencyRecord(
+            key=i_key,
+            expires=now + timedelta(seconds=IDEMPOTENCY_PENDING_SECONDS))
+        record.put()
+        return record, True
+
+    def _idempotencyKey(self, request, name):
+        """Return the record key for the user, endpoint and idempotency
+        key of a request, or None if the request has no key."""
+        if not request.idempotencyKey:
+            return None
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return ndb.Key(IdempotencyRecord, '%s:%s:%s' % (
+            getUserId(user), name, request.idempotencyKey))
+
+    def _idempotent(self, request, name, responseClass, run):
+        """Return run() at most once per user, endpoint and idempotency
+        key; without a key, just return run()."""
+        i_key = self._idempotencyKey(request, name)
+        if not i_key:
+            return run()
+        record, claimed = self._claimIdempotencyKey(i_key)
+        if not claimed:
+            if record.response is None:
+                raise ConflictException(
+                    'A request with this idempotency key is in progress.')
+            return protojson.decode_message(responseClass, record.response)
+
+        try:
+            response = run()
+        except Exception:
+            # failed calls store nothing, so the client can retry
+            i_key.delete()
+            raise
+        record.response = protojson.encode_message(response)
+        record.expires = datetime.now() + timedelta(seconds=IDEMPOTENCY_TTL)
+        record.put()
+        return response
+
+    @staticmethod
+    def _purgeIdempotencyRecords(cursor=None):
+        """Delete a batch of expired idempotency records; used by the purge
+        cron job. Re-enqueues itself with a cursor until done."""
+        q = IdempotencyRecord.query(
+            IdempotencyRecord.expires < datetime.now())
+        i_keys, nextCursor, more = q.fetch_page(
+            IDEMPOTENCY_PURGE_BATCH, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        ndb.delete_multi(i_keys)
+        if more and nextCursor:
+            taskqueue.add(params={'cursor': nextCursor.urlsafe()},
+                          url='/tasks/purge_idempotency_records')
+
+    # - - - Transaction stats - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(message_types.VoidMessage,
+                      TransactionStatsForms,
+                      path='stats/transactions',
+                      http_method='GET',
+                      name='getTransactionStats')
+    def getTransactionStats(self, request):
+        """Return commit attempt, collision and failure counts per
+        transaction type, to spot hot entity groups."""
+        if not endpoints.get_current_user():
+            raise endpoints.UnauthorizedException('Authorization required')
+        return TransactionStatsForms(items=[
+            TransactionStatsForm(name=name, **counters)
+            for name, counters in sorted(getTransactionStats().items())])
+
+    # - - - Field masks - - - - - - - - - - - - - - - - - - - -
+
+    def _checkFieldMask(self, fields, formClass):
+        """Validate a requested field mask against a form; an empty mask
+        means every field."""
+        known = set(field.name for field in formClass.all_fields())
+        unknown = sorted(set(fields) - known)
+        if unknown:
+            raise endpoints.BadRequestException(
+                'Unknown fields: %s' % ', '.join(unknown))
+        return list(fields)
+
+    def _projectionFor(self, fields, indexed):
+        """Return the properties to project for a field mask, or None if
+        the mask needs full entities. Only a mask of the one property the
+        query's index is sorted on is projected, as anything else needs
+        another composite index; websafeKey comes with every result."""
+        props = [f for f in fields if f != 'websafeKey']
+        if not indexed or props != [indexed]:
+            return None
+        return props
+
+    def _maskForms(self, forms, fields):
+        """Clear every field not in the mask from a list of forms."""
+        if fields:
+            for form in forms:
+                for field in form.all_fields():
+                    if field.name not in fields:
+                        form.reset(field.name)
+        return forms
+
+    def _fetchProjected(self, q, projection):
+        """Fetch a query, as a projection if one is given."""
+        if projection:
+            return q.fetch(projection=projection)
+        return q.fetch()
+
     # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
+    def _copyConferenceToForm(self, conf, displayName=None, fields=None):
+        """Copy relevant fields from Conference to ConferenceForm, or only
+        those in fields if given."""
         cf = ConferenceForm()
         for field in cf.all_fields():
+            if fields and field.name not in fields:
+                continue
             if hasattr(conf, field.name):
                 # convert Date to date string; just copy others
                 if field.name.endswith('Date'):
@@ -128,20 +412,58 @@ class ConferenceApi(remote.Service):
                     setattr(cf, field.name, getattr(conf, field.name))
             elif field.name == "websafeKey":
                 setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
+        if displayName and (not fields or 'organizerDisplayName' in fields):
             setattr(cf, 'organizerDisplayName', displayName)
+        if (not fields or 'etag' in fields) and hasattr(conf, 'version'):
+            setattr(cf, 'etag', self._etagFor(conf.version))
         cf.check_initialized()
         return cf
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning
-        ConferenceForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
+    def _etagFor(self, version, seats=None):
+        """Return a Conference's etag. Registrations change only the seat
+        shards, so for a sharded conference the live seat total is part
+        of it alongside the version."""
+        if seats is None:
+            return str(version or 0)
+        return '%d-%d' % (version or 0, seats)
+
+    @ndb.tasklet
+    def _copyConferencesToFormsAsync(self, conferences, fields=None):
+        """Copy Conferences to ConferenceForms. Organizer profiles are only
+        fetched (in one batch) for conferences stored before the display
+        name was kept on Conference."""
+        missing = set()
+        if not fields or 'organizerDisplayName' in fields:
+            missing = set(conf.key.parent() for conf in conferences
+                          if conf.organizerDisplayName is None)
+        names = {}
+        if missing:
+            profs = yield ndb.get_multi_async(list(missing))
+            names = {prof.key: prof.displayName for prof in profs if prof}
+        forms = [self._copyConferenceToForm(
+            conf, names.get(conf.key.parent()), fields)
+            for conf in conferences]
+
+        # seat shards, not the Conference, hold the live count
+        if not fields or 'seatsAvailable' in fields or 'etag' in fields:
+            seats = yield self._getSeatsAvailableAsync(conferences)
+            for conf, form in zip(conferences, forms):
+                if conf.key not in seats:
+                    continue
+                if not fields or 'seatsAvailable' in fields:
+                    form.seatsAvailable = seats[conf.key]
+                if not fields or 'etag' in fields:
+                    form.etag = self._etagFor(conf.version, seats[conf.key])
+        raise ndb.Return(forms)
+
+    def _copyConferencesToForms(self, conferences, fields=None):
+        """Synchronous wrapper around _copyConferencesToFormsAsync()."""
+        return self._copyConferencesToFormsAsync(
+            conferences, fields).get_result()
+
+    def _conferenceDataFromForm(self, request):
+        """Validate a ConferenceForm and turn it into Conference properties,
+        filling in defaults on both."""
         if not request.name:
             raise endpoints.BadRequestException(
                 "Conference 'name' field required")
@@ -151,6 +473,8 @@ class ConferenceApi(remote.Service):
                 for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['etag']
+        del data['notModified']
 
         # add default values for those missing (both data model & outbound
         # Message)
@@ -161,37 +485,134 @@ class ConferenceApi(remote.Service):
 
         # convert dates from strings to Date objects; set month based on
         # start_date
-        if data['startDate']:
-            data['startDate'] = datetime.strptime(data['startDate'][:10],
-                                                  "%Y-%m-%d").date()
-            data['month'] = data['startDate'].month
-        else:
-            data['month'] = 0
-        if data['endDate']:
-            data['endDate'] = datetime.strptime(data['endDate'][:10],
-                                                "%Y-%m-%d").date()
+        try:
+            if data['startDate']:
+                data['startDate'] = datetime.strptime(
+                    data['startDate'][:10], "%Y-%m-%d").date()
+                data['month'] = data['startDate'].month
+            else:
+                data['month'] = 0
+            if data['endDate']:
+                data['endDate'] = datetime.strptime(data['endDate'][:10],
+                                                    "%Y-%m-%d").date()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                'Conference dates must be formatted YYYY-MM-DD')
 
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
-        # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID
+        return data
+
+    def _createConferenceObject(self, request, i_key=None):
+        """Create or update Conference object, returning
+        ConferenceForm/request. With an idempotency record key, a retry
+        gets the first call's response back."""
+        # preload necessary data items
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        data = self._conferenceDataFromForm(request)
+
+        # generate Profile Key based on user ID; the datastore assigns the
+        # Conference ID under it as part of the put
         p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
-        data['key'] = c_key
+        data['parent'] = p_key
         data['organizerUserId'] = request.organizerUserId = user_id
+        prof = p_key.get()
+        data['organizerDisplayName'] = request.organizerDisplayName = (
+            prof.displayName if prof else user.nickname())
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        print(Conference(**data).put().urlsafe())  # for debugging
-        # Conference(**data).put().urlsafe()  # for production
+        if i_key:
+            # the ID has to be known before the transaction that stores it
+            # in the idempotency record's response
+            data['id'] = Conference.allocate_ids(size=1, parent=p_key)[0]
+            request.websafeKey = ndb.Key(
+                Conference, data['id'], parent=p_key).urlsafe()
+            return self._saveConference(Conference(**data), request,
+                                        user.email(), i_key)
+        request.websafeKey = Conference(**data).put().urlsafe()
         taskqueue.add(params={'email': user.email(),
                               'conferenceInfo': repr(request)},
                       url='/tasks/send_confirmation_email')
         return request
 
-    @ndb.transactional()
+    @staticmethod
+    @transactional('createConference', xg=True)
+    def _saveConference(conf, form, email, i_key):
+        """Put a new conference, its idempotency record and its
+        confirmation email task atomically. Returns the form, or the
+        stored response if the record already holds one."""
+        now = datetime.now()
+        record = i_key.get()
+        if record and record.response is not None and record.expires > now:
+            return protojson.decode_message(ConferenceForm, record.response)
+        ndb.put_multi([conf, IdempotencyRecord(
+            key=i_key, response=protojson.encode_message(form),
+            expires=now + timedelta(seconds=IDEMPOTENCY_TTL))])
+        taskqueue.add(params={'email': email, 'conferenceInfo': repr(form)},
+                      url='/tasks/send_confirmation_email',
+                      transactional=True)
+        return form
+
+    def _createConferenceObjects(self, forms):
+        """Create many Conferences with one put_multi and batched
+        confirmation email tasks. Returns a ConferenceResult per
+        form, in order; invalid or failed items carry an error instead of
+        failing the batch."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        if len(forms) > MAX_BATCH_SIZE:
+            raise endpoints.BadRequestException(
+                'At most %d conferences per batch.' % MAX_BATCH_SIZE)
+
+        results = [ConferenceResult() for _ in forms]
+        valid = []
+        for i, form in enumerate(forms):
+            try:
+                valid.append((i, form, self._conferenceDataFromForm(form)))
+            except endpoints.BadRequestException as e:
+                results[i].error = str(e)
+        if not valid:
+            return ConferenceResults(items=results)
+
+        p_key = ndb.Key(Profile, user_id)
+        prof = p_key.get()
+        displayName = prof.displayName if prof else user.nickname()
+        conferences = []
+        for i, form, data in valid:
+            # ids are assigned by the put_multi itself
+            data['parent'] = p_key
+            data['organizerUserId'] = form.organizerUserId = user_id
+            data['organizerDisplayName'] = form.organizerDisplayName = \
+                displayName
+            conferences.append(Conference(**data))
+
+        tasks = []
+        futures = ndb.put_multi_async(conferences)
+        for (i, form, data), future in zip(valid, futures):
+            try:
+                form.websafeKey = future.get_result().urlsafe()
+            except datastore_errors.Error as e:
+                results[i].error = 'Could not save conference: %s' % e
+                continue
+            results[i].conference = form
+            tasks.append(taskqueue.Task(
+                params={'email': user.email(), 'conferenceInfo': repr(form)},
+                url='/tasks/send_confirmation_email'))
+
+        queue = taskqueue.Queue()
+        for start in range(0, len(tasks), MAX_TASKS_PER_ADD):
+            queue.add(tasks[start:start + MAX_TASKS_PER_ADD])
+        return ConferenceResults(items=results)
+
+    @transactional('updateConference', xg=True)
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
@@ -214,9 +635,25 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # once seats are sharded, the shards hold the count: it can't be
+        # set directly, and a new maxAttendees moves the difference onto
+        # the shards
+        if conf.seatShards:
+            if request.seatsAvailable is not None:
+                raise endpoints.BadRequestException(
+                    "'seatsAvailable' follows registrations and can't be "
+                    "set once registration has started.")
+            if request.maxAttendees is not None:
+                delta = request.maxAttendees - (conf.maxAttendees or 0)
+                if delta:
+                    self._resizeSeatShards(conf, delta)
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
+            if field.name in ('organizerUserId', 'organizerDisplayName',
+                              'etag', 'notModified'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -227,19 +664,58 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        print(conf.put().urlsafe())  # For debugging
-        # conf.put()  # For production
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
-
-    @endpoints.method(ConferenceForm,
+        # a conference whose endDate moves into the future is active again;
+        # the archive job only looks at active ones
+        if request.endDate:
+            conf.isActive = conf.endDate >= date.today()
+        conf.put()
+        return conf
+
+    def _resizeSeatShards(self, conf, delta):
+        """Spread delta added seats over a sharded Conference's seat shards,
+        or take -delta seats from the fullest ones; runs inside the update
+        transaction."""
+        shards = ndb.get_multi(SeatShard.keysFor(conf.key, conf.seatShards))
+        if delta > 0:
+            base, extra = divmod(delta, len(shards))
+            for i, shard in enumerate(shards):
+                shard.seatsAvailable += base + (i < extra)
+        else:
+            if sum(shard.seatsAvailable for shard in shards) < -delta:
+                raise endpoints.BadRequestException(
+                    "'maxAttendees' can't drop below the seats already "
+                    "taken.")
+            remaining = -delta
+            for shard in sorted(shards,
+                                key=lambda shard: -shard.seatsAvailable):
+                taken = min(remaining, shard.seatsAvailable)
+                shard.seatsAvailable -= taken
+                remaining -= taken
+        ndb.put_multi(shards)
+        conf.seatsAvailable = (conf.seatsAvailable or 0) + delta
+        ndb.get_context().call_on_commit(
+            lambda: self._seatsChanged(conf.key, delta))
+
+    @endpoints.method(CONF_CREATE_REQUEST,
                       ConferenceForm,
                       path='conference',
                       http_method='POST',
                       name='createConference')
     def createConference(self, request):
         """Create new conference."""
-        return self._createConferenceObject(request)
+        form = ConferenceForm(**{field.name: getattr(request, field.name)
+                                 for field in ConferenceForm.all_fields()})
+        return self._createConferenceObject(
+            form, self._idempotencyKey(request, 'createConference'))
+
+    @endpoints.method(ConferenceForms,
+                      ConferenceResults,
+                      path='conferences',
+                      http_method='POST',
+                      name='createConferences')
+    def createConferences(self, request):
+        """Create many conferences at once, reporting errors per item."""
+        return self._createConferenceObjects(request.items)
 
     @endpoints.method(CONF_POST_REQUEST,
                       ConferenceForm,
@@ -248,68 +724,152 @@ class ConferenceApi(remote.Service):
                       name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        conf = self._updateConferenceObject(request)
+        return self._copyConferencesToForms([conf])[0]
 
-    @endpoints.method(GET_OR_DELETE_REQUEST,
+    @endpoints.method(CONF_GET_REQUEST,
                       ConferenceForm,
                       path='conference/{inputString}',
                       http_method='GET',
                       name='getConference')
     def getConference(self, request):
-        """Return requested conference (by inputString)."""
+        """Return requested conference (by inputString). If ifNoneMatch
+        holds the current etag, return an empty not-modified form."""
+        wsck = request.inputString
+        if request.ifNoneMatch:
+            # a cached seat total means the conference is sharded; without
+            # one, a sharded conference's etag can't match here
+            cached = memcache.get_multi([MEMCACHE_CONF_VERSION_KEY % wsck,
+                                         MEMCACHE_SEATS_KEY % wsck])
+            version = cached.get(MEMCACHE_CONF_VERSION_KEY % wsck)
+            if version is not None and self._etagFor(
+                    version, cached.get(MEMCACHE_SEATS_KEY % wsck)) == \
+                    request.ifNoneMatch:
+                return self._notModifiedForm(wsck, request.ifNoneMatch)
+        return self._getConferenceAsync(wsck,
+                                        request.ifNoneMatch).get_result()
+
+    def _notModifiedForm(self, wsck, etag):
+        """Return the empty ConferenceForm that answers a matching
+        ifNoneMatch."""
+        return ConferenceForm(websafeKey=wsck, etag=etag, notModified=True)
+
+    @ndb.tasklet
+    def _getConferenceAsync(self, wsck, ifNoneMatch=None):
+        """Fetch a Conference (and, if needed, its organizer) as a form."""
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.inputString).get()
+        conf = yield ndb.Key(urlsafe=wsck).get_async()
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.inputString)
-        prof = conf.key.parent().get()
+                'No conference found with key: %s' % wsck)
+        # remember the version for later conditional requests
+        memcache.add(MEMCACHE_CONF_VERSION_KEY % wsck, conf.version or 0,
+                     time=VERSION_CACHE_TTL)
+        if ifNoneMatch:
+            seats = yield self._getSeatsAvailableAsync([conf])
+            if ifNoneMatch == self._etagFor(conf.version,
+                                            seats.get(conf.key)):
+                raise ndb.Return(self._notModifiedForm(wsck, ifNoneMatch))
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        forms = yield self._copyConferencesToFormsAsync([conf])
+        raise ndb.Return(forms[0])
 
-    @endpoints.method(message_types.VoidMessage,
+    @endpoints.method(CONF_KEYS_REQUEST,
+                      ConferenceResults,
+                      path='conferences/batchGet',
+                      http_method='POST',
+                      name='getConferencesByKeys')
+    def getConferencesByKeys(self, request):
+        """Return many conferences by websafe key, in request order; keys
+        that are invalid or not found are flagged per item."""
+        if len(request.websafeKeys) > MAX_BATCH_SIZE:
+            raise endpoints.BadRequestException(
+                'At most %d conferences per batch.' % MAX_BATCH_SIZE)
+        fields = self._checkFieldMask(request.fields, ConferenceForm)
+        return self._getConferenceResultsAsync(
+            request.websafeKeys, fields).get_result()
+
+    @ndb.tasklet
+    def _getConferenceResultsAsync(self, websafeKeys, fields=None):
+        """Fetch Conferences (and, if needed, their organizers) with one
+        get_multi each, as a ConferenceResult per websafe key."""
+        results = [ConferenceResult() for _ in websafeKeys]
+        keys = {}
+        for i, wsck in enumerate(websafeKeys):
+            key = self._keyFromWebsafe(wsck, Conference)
+            if key is None:
+                results[i].error = 'Invalid conference key: %s' % wsck
+            else:
+                keys[i] = key
+
+        # duplicate keys are fetched once
+        unique = list(set(keys.values()))
+        conferences = yield ndb.get_multi_async(unique)
+        found = dict((conf.key, conf) for conf in conferences if conf)
+        forms = yield self._copyConferencesToFormsAsync(found.values(), fields)
+        formsByKey = dict(zip(found.keys(), forms))
+
+        for i, key in keys.items():
+            if key in formsByKey:
+                results[i].conference = formsByKey[key]
+            else:
+                results[i].error = ('No conference found with key: %s' %
+                                    websafeKeys[i])
+        raise ndb.Return(ConferenceResults(items=results))
+
+    @endpoints.method(FIELDS_REQUEST,
                       ConferenceForms,
                       path='getConferencesCreated',
                       http_method='POST',
                       name='getConferencesCreated')
     def getConferencesCreated(self, request):
-        """Return conferences created by user."""
+        """Return conferences created by user, limited to the requested
+        fields if any."""
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
-
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
-        # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, getattr(
-            prof, 'displayName')) for conf in confs])
-
-    def _getQuery(self, request):
+        fields = self._checkFieldMask(request.fields, ConferenceForm)
+
+        # The full list is cached per organizer and dropped by the
+        # Conference put hook; one request at a time rebuilds it.
+        def build():
+            # create ancestor query for all key matches for this user
+            confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
+            # return set of ConferenceForm objects per Conference
+            return protojson.encode_message(ConferenceForms(
+                items=self._copyConferencesToForms(confs.fetch())))
+
+        forms = protojson.decode_message(ConferenceForms, getOrCompute(
+            MEMCACHE_CREATED_KEY % user_id, build, ttl=CREATED_CACHE_TTL))
+        self._maskForms(forms.items, fields)
+        return forms
+
+    def _getQuery(self, inequality_field, filters):
         """Return formatted query from the submitted filters."""
         q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
 
         # If exists, sort on inequality filter first
-        if not inequality_filter:
+        if not inequality_field:
             q = q.order(Conference.name)
         else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
+            q = q.order(ndb.GenericProperty(inequality_field))
             q = q.order(Conference.name)
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(
                 filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
         return q
 
     def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
+        """Parse, check validity and format user supplied filters.
+
+        Returns the list of distinct fields carrying an inequality (in the
+        order first seen) along with the formatted filters."""
         formatted_filters = []
-        inequality_field = None
+        inequality_fields = []
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name)
@@ -322,20 +882,204 @@ class ConferenceApi(remote.Service):
                 raise endpoints.BadRequestException(
                     "Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous
-                # filters disallow the filter if inequality was performed on a
-                # different field before track the field on which the
-
-                if inequality_field and inequality_field != filtr["field"]:
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
                     raise endpoints.BadRequestException(
-                        "Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
+                        "Filter on %s requires a number." % filtr["field"])
+
+            # Every operation except "=" is an inequality; track the fields
+            # so the planner can split multi-field requests.
+            if filtr["operator"] != "=" and \
+                    filtr["field"] not in inequality_fields:
+                inequality_fields.append(filtr["field"])
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return (inequality_fields, formatted_filters)
+
+    def _canonicalizeFilters(self, filters):
+        """Merge redundant filters and sort them into a stable form.
+
+        Per field, the tightest lower and upper bounds win, a closed range
+        on a single value becomes an equality, and on single-valued fields
+        an equality absorbs the other predicates it satisfies. Returns the
+        inequality fields and canonical filters like _formatFilters, or None
+        if the filters can never match."""
+        byField = {}
+        for filtr in filters:
+            byField.setdefault(filtr["field"], []).append(filtr)
+
+        canonical = []
+        for field in sorted(byField):
+            equals, notEquals = set(), set()
+            lower = upper = None  # (value, strict)
+            for filtr in byField[field]:
+                op, value = filtr["operator"], filtr["value"]
+                if op == "=":
+                    equals.add(value)
+                elif op == "!=":
+                    notEquals.add(value)
+                elif op in (">", ">="):
+                    bound = (value, op == ">")
+                    if lower is None or bound > lower:
+                        lower = bound
+                else:
+                    bound = (value, op == "<")
+                    if upper is None or (value, not bound[1]) < (
+                            upper[0], not upper[1]):
+                        upper = bound
+
+            if lower and upper:
+                if lower[0] > upper[0] or (lower[0] == upper[0] and
+                                           (lower[1] or upper[1])):
+                    return None
+                if lower[0] == upper[0]:
+                    equals.add(lower[0])
+                    lower = upper = None
+
+            if equals and field not in REPEATED_FIELDS:
+                if len(equals) > 1:
+                    return None
+                value = list(equals)[0]
+                if value in notEquals or \
+                        (lower and not FILTER_OPS[">" if lower[1] else ">="](
+                            value, lower[0])) or \
+                        (upper and not FILTER_OPS["<" if upper[1] else "<="](
+                            value, upper[0])):
+                    return None
+                lower = upper = None
+                notEquals = set()
+
+            for value in sorted(equals):
+                canonical.append({"field": field, "operator": "=",
+                                  "value": value})
+            if lower:
+                canonical.append({"field": field,
+                                  "operator": ">" if lower[1] else ">=",
+                                  "value": lower[0]})
+            if upper:
+                canonical.append({"field": field,
+                                  "operator": "<" if upper[1] else "<=",
+                                  "value": upper[0]})
+            for value in sorted(notEquals):
+                canonical.append({"field": field, "operator": "!=",
+                                  "value": value})
+
+        inequality_fields = sorted(set(filtr["field"] for filtr in canonical
+                                       if filtr["operator"] != "="))
+        return (inequality_fields, canonical)
+
+    def _queryCacheKey(self, filters, request):
+        """Memcache key for a canonical filter set and page."""
+        form = [(f["field"], f["operator"], f["value"]) for f in filters]
+        digest = hashlib.sha1(repr((form, request.pageSize, request.pageToken,
+                                    sorted(request.fields)))).hexdigest()
+        return MEMCACHE_QUERY_KEY % (getConferenceGeneration(), digest)
+
+    def _matchesFilter(self, conf, filtr):
+        """Check a single formatted filter against a Conference in memory.
+
+        Mirrors datastore semantics for repeated properties: the filter
+        matches if any of the values satisfies it."""
+        values = getattr(conf, filtr["field"])
+        if not isinstance(values, list):
+            values = [values]
+        compare = FILTER_OPS[filtr["operator"]]
+        return any(v is not None and compare(v, filtr["value"])
+                   for v in values)
+
+    def _planInequalityQuery(self, filters):
+        """Answer filters with inequalities on more than one field.
+
+        The datastore allows an inequality on a single property per query,
+        so split the request into one keys-only sub-query per inequality
+        field (each also carrying the equality filters). Bounded count
+        estimates pick the most selective sub-query to drive: if it is
+        small, only its entities are fetched and the remaining predicates
+        are checked in memory; otherwise all sub-queries run in parallel
+        and their key sets are intersected. Either way only the survivors
+        are batch-fetched. Results are ordered by name."""
+        equalities = [f for f in filters if f["operator"] == "="]
+        byField = {}
+        for filtr in filters:
+            if filtr["operator"] != "=":
+                byField.setdefault(filtr["field"], []).append(filtr)
+
+        subQueries = []
+        for field in byField:
+            q = Conference.query()
+            for filtr in equalities + byField[field]:
+                q = q.filter(ndb.query.FilterNode(
+                    filtr["field"], filtr["operator"], filtr["value"]))
+            subQueries.append(q)
+
+        # Count estimates are keys-only index scans, capped so they stay cheap
+        countFutures = [q.count_async(limit=PLANNER_COUNT_LIMIT)
+                        for q in subQueries]
+        estimates = [future.get_result() for future in countFutures]
+        order = sorted(range(len(subQueries)), key=lambda i: estimates[i])
+        driver = order[0]
+
+        if estimates[driver] == 0:
+            return []
+        if estimates[driver] <= PLANNER_DRIVER_LIMIT:
+            keys = subQueries[driver].fetch(keys_only=True)
+        else:
+            keyFutures = [q.fetch_async(keys_only=True) for q in subQueries]
+            keys = set(keyFutures[driver].get_result())
+            for i in order[1:]:
+                keys.intersection_update(keyFutures[i].get_result())
+                if not keys:
+                    return []
+
+        # Indexes are eventually consistent, so re-check every predicate on
+        # the fetched entities before returning them.
+        conferences = [conf for conf in ndb.get_multi(list(keys))
+                       if conf and all(self._matchesFilter(conf, filtr)
+                                       for filtr in filters)]
+        return sorted(conferences, key=lambda conf: conf.name)
+
+    def _fetchPage(self, q, request, projection=None):
+        """Fetch one page of a query by cursor, or all of it without a
+        pageSize. Returns the results and the token for the next page."""
+        if not request.pageSize:
+            return self._fetchProjected(q, projection), None
+        if request.pageSize < 0:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be a positive number.")
+        cursor = None
+        if request.pageToken:
+            try:
+                cursor = Cursor(urlsafe=request.pageToken)
+            except (datastore_errors.BadValueError, TypeError):
+                raise endpoints.BadRequestException(
+                    'Invalid pageToken: %s' % request.pageToken)
+        pageSize = min(request.pageSize, MAX_PAGE_SIZE)
+        options = {'projection': projection} if projection else {}
+        results, nextCursor, more = q.fetch_page(
+            pageSize, start_cursor=cursor, **options)
+        if more and nextCursor:
+            return results, nextCursor.urlsafe()
+        return results, None
+
+    def _slicePage(self, results, request):
+        """Page through an in-memory result list; the page token is the
+        offset of the next page."""
+        if not request.pageSize:
+            return results, None
+        if request.pageSize < 0:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be a positive number.")
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise endpoints.BadRequestException(
+                'Invalid pageToken: %s' % request.pageToken)
+        end = offset + min(request.pageSize, MAX_PAGE_SIZE)
+        return results[offset:end], str(end) if end < len(results) else None
 
     @endpoints.method(ConferenceQueryForms,
                       ConferenceForms,
@@ -343,27 +1087,53 @@ class ConferenceApi(remote.Service):
                       http_method='POST',
                       name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId))
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        """Query for conferences, one page at a time if pageSize is given."""
+        filters = self._formatFilters(request.filters)[1]
+        # archived conferences are left out of listings
+        filters.append({"field": "isActive", "operator": "=", "value": True})
+        fields = self._checkFieldMask(request.fields, ConferenceForm)
+
+        # Equivalent filter sets share one canonical form, and with it one
+        # cached result; the generation in the key moves on every
+        # Conference put, which invalidates all cached results at once.
+        canonical = self._canonicalizeFilters(filters)
+        if canonical is None:
+            return ConferenceForms(items=[])
+        inequality_fields, filters = canonical
+        cacheKey = self._queryCacheKey(filters, request)
+        cached = memcache.get(cacheKey)
+        if cached is not None:
+            return protojson.decode_message(ConferenceForms, cached)
+
+        # Page through the results with a datastore cursor so a listing costs
+        # one bounded query; without a pageSize fall back to the full result.
+        # Inequalities on several fields go through the query planner.
+        # A mask of just the name is served from a projection on the
+        # (isActive, name) index when nothing else is filtered.
+        if len(inequality_fields) > 1:
+            conferences, nextPageToken = self._slicePage(
+                self._planInequalityQuery(filters), request)
+        else:
+            q = self._getQuery(
+                inequality_fields[0] if inequality_fields else None, filters)
+            activeOnly = all(f["field"] == "isActive" and
+                             f["operator"] == "=" for f in filters)
+            projection = self._projectionFor(
+                fields, 'name' if activeOnly else None)
+            conferences, nextPageToken = self._fetchPage(q, request,
+                                                         projection)
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[
-            conf.organizerUserId]) for conf in conferences])
+        forms = ConferenceForms(
+            items=self._copyConferencesToForms(conferences, fields),
+            nextPageToken=nextPageToken)
+        memcache.set(cacheKey, protojson.encode_message(forms),
+                     time=QUERY_CACHE_TTL)
+        return forms
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
-    def _copyProfileToForm(self, prof):
+    def _copyProfileToForm(self, prof, withAttending=True):
         """Copy relevant fields from Profile to ProfileForm."""
         # copy relevant fields from Profile to ProfileForm
         pf = ProfileForm()
@@ -375,6 +1145,8 @@ class ConferenceApi(remote.Service):
                                                     getattr(prof, field.name)))
                 else:
                     setattr(pf, field.name, getattr(prof, field.name))
+        if withAttending:
+            pf.conferenceKeysToAttend = self._getAttendingKeys(prof)
         pf.check_initialized()
         return pf
 
@@ -397,6 +1169,8 @@ class ConferenceApi(remote.Service):
                               teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED), )
             print(profile.put().urlsafe())  # for debugging
             # profile.put()  # for production
+        elif profile.conferenceKeysToAttend:
+            self._enqueueMigration(user_id)
 
         return profile  # return Profile
 
@@ -411,6 +1185,7 @@ class ConferenceApi(remote.Service):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
                     if val:
+                        changed = getattr(prof, field) != str(val)
                         setattr(prof, field, str(val))
                         # if field == 'teeShirtSize':
                         #    setattr(prof, field, str(val).upper())
@@ -418,10 +1193,93 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, val)
                         print(prof.put().urlsafe())  # for debugging
                         # prof.put()  # for productiong
+                        # conferences carry a copy of the display name
+                        if field == 'displayName' and changed:
+                            taskqueue.add(
+                                params={'userId': prof.key.id()},
+                                url='/tasks/update_organizer_display_name')
 
                         # return ProfileForm
         return self._copyProfileToForm(prof)
 
+    @staticmethod
+    def _updateOrganizerDisplayName(user_id, cursor=None):
+        """Copy an organizer's display name onto a batch of their
+        conferences; used by the saveProfile() task. Re-enqueues itself
+        with a cursor until every conference is updated."""
+        p_key = ndb.Key(Profile, user_id)
+        q = Conference.query(ancestor=p_key)
+        c_keys, nextCursor, more = q.fetch_page(
+            ORGANIZER_UPDATE_BATCH, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        if c_keys:
+            ConferenceApi._setOrganizerDisplayName(p_key, c_keys)
+        if more and nextCursor:
+            taskqueue.add(params={'userId': user_id,
+                                  'cursor': nextCursor.urlsafe()},
+                          url='/tasks/update_organizer_display_name')
+
+    @staticmethod
+    @transactional('setOrganizerDisplayName')
+    def _setOrganizerDisplayName(p_key, c_keys):
+        """Re-read an organizer's Profile and a batch of their conferences
+        (one entity group) and copy the display name onto the stale
+        ones."""
+        entities = ndb.get_multi([p_key] + c_keys)
+        prof = entities[0]
+        if not prof:
+            return
+        stale = [conf for conf in entities[1:]
+                 if conf and conf.organizerDisplayName != prof.displayName]
+        for conf in stale:
+            conf.organizerDisplayName = prof.displayName
+        ndb.put_multi(stale)
+
+    @staticmethod
+    @transactional('setActive')
+    def _setActive(c_keys, today, backfill=False):
+        """Re-read conferences of one entity group and set isActive from
+        their endDate, writing only those that change (or, with backfill,
+        all of them)."""
+        changed = []
+        for conf in ndb.get_multi(c_keys):
+            if not conf:
+                continue
+            # unset dates sort before every date, so check in memory too
+            isActive = conf.endDate is None or conf.endDate >= today
+            if backfill or conf.isActive != isActive:
+                conf.isActive = isActive
+                changed.append(conf)
+        ndb.put_multi(changed)
+
+    @staticmethod
+    def _archivePastConferences(cursor=None, backfill=False):
+        """Mark a batch of conferences whose endDate has passed as
+        inactive; used by the archive cron job. Re-enqueues itself with a
+        cursor until done. With backfill, every conference is visited so
+        entities written before isActive existed get the property."""
+        today = date.today()
+        if backfill:
+            q = Conference.query()
+        else:
+            q = Conference.query(Conference.isActive == True,
+                                 Conference.endDate < today)
+        c_keys, nextCursor, more = q.fetch_page(
+            ARCHIVE_BATCH, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        # conferences are children of their organizer's Profile; update
+        # each organizer's batch in one transaction
+        byOrganizer = {}
+        for c_key in c_keys:
+            byOrganizer.setdefault(c_key.parent(), []).append(c_key)
+        for keys in byOrganizer.values():
+            ConferenceApi._setActive(keys, today, backfill)
+        if more and nextCursor:
+            params = {'cursor': nextCursor.urlsafe()}
+            if backfill:
+                params['backfill'] = '1'
+            taskqueue.add(params=params, url='/tasks/archive_conferences')
+
     @endpoints.method(message_types.VoidMessage,
                       ProfileForm,
                       path='profile',
@@ -442,28 +1300,186 @@ class ConferenceApi(remote.Service):
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
+    # Banners (the nearly sold out set and the featured speaker) are kept
+    # in memcache and persisted as Banner entities. After an eviction one
+    # request regenerates the memcache entry while the rest are served the
+    # persisted value, so nobody sees a blank banner. Every client reads
+    # them, so each is written to HOT_KEY_REPLICAS memcache keys and read
+    # from one picked at random, spreading the load over memcache servers.
+    # Each write carries a version, and neither the Banner nor a copy is
+    # ever replaced by an older one.
+
+    # Instances also keep banners in BANNER_CACHE for BANNER_LOCAL_TTL
+    # seconds, so most reads make no RPC at all. A write bumps the banner's
+    # version in memcache; once the local copy expires, an unchanged
+    # version renews it without reading the banner again.
+
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
-        confs = Conference.query(ndb.AND(Conference.seatsAvailable <= 5,
-                                         Conference.seatsAvailable > 0)).fetch(
-                                             projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (', '.join(conf.name
-                                                         for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    @transactional('saveBanner')
+    def _saveBanner(key, value, version=None):
+        """Persist a banner unless a newer version is stored; without a
+        version, the next one is used. Returns the version stored, or None
+        if it was skipped."""
+        banner = Banner.get_by_id(key)
+        current = banner.version if banner else 0
+        if version is None:
+            version = current + 1
+        elif version <= current:
+            return None
+        Banner(id=key, value=value, version=version).put()
+        return version
+
+    @staticmethod
+    def _setBanner(key, value, version=None):
+        """Persist a banner and publish it to its memcache copies."""
+        version = ConferenceApi._saveBanner(key, value, version)
+        if version is not None:
+            setReplicated(key, value, version)
+            ConferenceApi._bannerChanged(key)
+
+    @staticmethod
+    def _bannerChanged(key):
+        """Invalidate instance copies of a banner. An evicted version is
+        reseeded from the clock, so it never repeats an earlier value."""
+        memcache.incr(MEMCACHE_BANNER_VERSION_KEY % key,
+                      initial_value=int(clock.time() * 1000))
+        BANNER_CACHE.delete(key)
+
+    @staticmethod
+    def _getLocalBanner(key, default):
+        """Read a banner through the instance cache."""
+        value = BANNER_CACHE.get(key)
+        if value is not None:
+            return value
+        versionKey = MEMCACHE_BANNER_VERSION_KEY % key
+        version = memcache.get(versionKey)
+        entry = BANNER_CACHE.peek(key)
+        if version is None:
+            # seed the version before reading the banner so a later write
+            # is noticed; a just-seeded version never renews a local copy
+            seed = int(clock.time() * 1000)
+            version = seed if memcache.add(versionKey, seed) else \
+                memcache.get(versionKey)
+            entry = None
+        if entry and version is not None and entry[1] == version:
+            value = entry[0]
         else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            value = ConferenceApi._getBanner(key, default)
+        BANNER_CACHE.set(key, value, BANNER_LOCAL_TTL, version)
+        return value
+
+    @staticmethod
+    def _lastKnownBanner(key, default):
+        """Return the persisted value of a banner."""
+        banner = Banner.get_by_id(key)
+        return banner.value if banner else default
 
-        return announcement
+    @staticmethod
+    def _getBanner(key, default):
+        """Read a banner from memcache; on a miss, one request refills it
+        from the persisted value behind a lease."""
+        def reload():
+            banner = Banner.get_by_id(key)
+            if not banner:
+                return {'value': default}
+            setReplicated(key, banner.value, banner.version)
+            return {'value': banner.value}
+
+        return readThrough(
+            key, reload,
+            lambda: {'value': ConferenceApi._lastKnownBanner(key, default)},
+            get=getReplicated)['value']
+
+    # The nearly sold out conferences are kept in memcache as a
+    # {websafeKey: name} dict. Registrations update it with compare-and-set
+    # when a conference's seat count crosses ANNOUNCEMENT_THRESHOLD, and the
+    # announcement is formatted from it on read. The compare-and-set runs
+    # on the plain key, which only writers touch and which also holds a
+    # version counter; each new set is then published with its version to
+    # the replicas readers use. The hourly cron rebuilds it from the
+    # datastore as a consistency backstop.
+
+    @staticmethod
+    def _formatAnnouncement(nearlySoldOut):
+        """Format the announcement for a nearly sold out set."""
+        if not nearlySoldOut:
+            return ""
+        return ANNOUNCEMENT_TPL % ', '.join(sorted(nearlySoldOut.values()))
+
+    @staticmethod
+    def _updateNearlySoldOut(update):
+        """Apply update() to a copy of the nearly sold out set and store it
+        with compare-and-set under the next version, retrying on concurrent
+        writes. Returns the stored {'version', 'conferences'}, or None if
+        nothing changed or it couldn't be stored."""
+        client = memcache.Client()
+        for _ in range(ANNOUNCEMENT_CAS_ATTEMPTS):
+            current = client.gets(MEMCACHE_ANNOUNCEMENTS_KEY)
+            base = current
+            if base is None:
+                # after an eviction, start over from the persisted set
+                banner = Banner.get_by_id(MEMCACHE_ANNOUNCEMENTS_KEY)
+                base = {'version': banner.version if banner else 0,
+                        'conferences': banner.value if banner else {}}
+            conferences = update(dict(base['conferences']))
+            updated = {'version': base['version'] + 1,
+                       'conferences': conferences}
+            if current is None:
+                # nothing to compare with; add() fails if another writer
+                # got there first
+                if client.add(MEMCACHE_ANNOUNCEMENTS_KEY, updated):
+                    return updated
+            elif conferences == current['conferences']:
+                return None
+            elif client.cas(MEMCACHE_ANNOUNCEMENTS_KEY, updated):
+                return updated
+        return None
+
+    @staticmethod
+    def _publishNearlySoldOut(update):
+        """Update the nearly sold out set and publish the result."""
+        updated = ConferenceApi._updateNearlySoldOut(update)
+        if updated:
+            ConferenceApi._setBanner(MEMCACHE_ANNOUNCEMENTS_KEY,
+                                     updated['conferences'],
+                                     updated['version'])
+
+    @staticmethod
+    def _cacheAnnouncement():
+        """Rebuild the nearly sold out set from the datastore; used by the
+        announcement cron job as a backstop. Returns the set."""
+        confs = Conference.query(ndb.AND(
+            Conference.isActive == True,
+            Conference.seatsAvailable <= ANNOUNCEMENT_THRESHOLD,
+            Conference.seatsAvailable > 0)).fetch(
+                projection=[Conference.name])
+        nearlySoldOut = dict((conf.key.urlsafe(), conf.name)
+                             for conf in confs)
+        ConferenceApi._publishNearlySoldOut(lambda current: nearlySoldOut)
+        return nearlySoldOut
+
+    def _seatsCrossedThreshold(self, c_key, seats, delta):
+        """Add a conference to, or drop it from, the nearly sold out set
+        when a seat change moved it across the announcement threshold."""
+        def announced(count):
+            return 0 < count <= ANNOUNCEMENT_THRESHOLD
+
+        if announced(seats) == announced(seats - delta):
+            return
+        wsck = c_key.urlsafe()
+        if announced(seats):
+            conf = c_key.get()
+            if not conf or not conf.isActive:
+                return
+
+            def update(nearlySoldOut):
+                nearlySoldOut[wsck] = conf.name
+                return nearlySoldOut
+        else:
+            def update(nearlySoldOut):
+                nearlySoldOut.pop(wsck, None)
+                return nearlySoldOut
+        self._publishNearlySoldOut(update)
 
     @endpoints.method(message_types.VoidMessage,
                       StringMessage,
@@ -472,92 +1488,432 @@ class ConferenceApi(remote.Service):
                       name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(
-            data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        return StringMessage(data=self._formatAnnouncement(
+            self._getLocalBanner(MEMCACHE_ANNOUNCEMENTS_KEY, {})))
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
-    def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser()  # get user Profile
+    # Seats are split across SeatShard entities, each its own entity group
+    # holding the Registrations of the users hashed to it, so concurrent
+    # registrations for one conference claim seats from different shards
+    # instead of serializing on the Conference. The
+    # aggregate is cached in memcache and folded back onto
+    # Conference.seatsAvailable (which the indexes use) at most once per
+    # SEAT_FOLD_INTERVAL.
+
+    @transactional('shardSeats', xg=True)
+    def _shardSeats(self, c_key):
+        """Split a Conference's available seats across seat shards; done
+        lazily on its first registration. Returns the Conference."""
+        conf = c_key.get()
+        if conf.seatShards:
+            return conf
+        # the shard count is fixed once Registrations hash onto it, so it
+        # does not depend on the seats of the moment; refills fill any
+        # shard left empty
+        seats = max(conf.seatsAvailable or 0, 0)
+        conf.seatShards = NUM_SEAT_SHARDS
+        base, extra = divmod(seats, conf.seatShards)
+        ndb.put_multi([SeatShard(key=key, seatsAvailable=base + (i < extra))
+                       for i, key in enumerate(
+                           SeatShard.keysFor(c_key, conf.seatShards))])
+        conf.put()
+        return conf
+
+    @ndb.tasklet
+    def _getSeatsAvailableAsync(self, conferences):
+        """Return {conference key: seats available} for the sharded
+        conferences among those given, from memcache where possible."""
+        sharded = [conf for conf in conferences if conf.seatShards]
+        if not sharded:
+            raise ndb.Return({})
+        cacheKeys = dict((MEMCACHE_SEATS_KEY % conf.key.urlsafe(), conf)
+                         for conf in sharded)
+        cached = memcache.get_multi(cacheKeys.keys())
+        seats = dict((cacheKeys[k].key, v) for k, v in cached.items())
+
+        missing = [conf for k, conf in cacheKeys.items() if k not in cached]
+        if missing:
+            shardKeys = [SeatShard.keysFor(conf.key, conf.seatShards)
+                         for conf in missing]
+            shards = yield ndb.get_multi_async(
+                [key for keys in shardKeys for key in keys])
+            mapping = {}
+            for conf in missing:
+                count = sum(shard.seatsAvailable
+                            for shard in shards[:conf.seatShards] if shard)
+                shards = shards[conf.seatShards:]
+                seats[conf.key] = count
+                mapping[MEMCACHE_SEATS_KEY % conf.key.urlsafe()] = count
+            memcache.add_multi(mapping, time=SEATS_CACHE_TTL)
+        raise ndb.Return(seats)
+
+    # A seat snapshot holds what changes only when the Conference is put
+    # (maxAttendees, the shard count, and the seat count of a conference
+    # not yet sharded); the Conference post-put hook deletes it. Sharded
+    # conferences add the live aggregate kept by _seatsChanged(), so a
+    # poll for any number of conferences is usually one memcache call.
+
+    @endpoints.method(SEATS_REQUEST,
+                      SeatAvailabilityForms,
+                      path='conferences/seats',
+                      http_method='GET',
+                      name='getSeatAvailability')
+    def getSeatAvailability(self, request):
+        """Return seats available and maxAttendees for many conferences,
+        skipping any that don't exist."""
+        if len(request.websafeKeys) > MAX_BATCH_SIZE:
+            raise endpoints.BadRequestException(
+                'At most %d keys per request.' % MAX_BATCH_SIZE)
+        wscks = []
+        for wsck in request.websafeKeys:
+            if not self._keyFromWebsafe(wsck, Conference):
+                raise endpoints.BadRequestException(
+                    'Invalid conference key: %s' % wsck)
+            if wsck not in wscks:
+                wscks.append(wsck)
+
+        cached = memcache.get_multi(
+            [MEMCACHE_SEAT_SNAPSHOT_KEY % wsck for wsck in wscks] +
+            [MEMCACHE_SEATS_KEY % wsck for wsck in wscks])
+        snapshots = dict((wsck, cached.get(MEMCACHE_SEAT_SNAPSHOT_KEY % wsck))
+                         for wsck in wscks)
+        seats = dict((wsck, cached[MEMCACHE_SEATS_KEY % wsck])
+                     for wsck in wscks if MEMCACHE_SEATS_KEY % wsck in cached)
+
+        # rebuild missing snapshots and seat aggregates from the datastore
+        stale = [wsck for wsck in wscks if not snapshots[wsck] or (
+            snapshots[wsck]['seatShards'] and wsck not in seats)]
+        if stale:
+            confs = [conf for conf in ndb.get_multi(
+                [ndb.Key(urlsafe=wsck) for wsck in stale]) if conf]
+            mapping = {}
+            for conf in confs:
+                wsck = conf.key.urlsafe()
+                snapshots[wsck] = {'maxAttendees': conf.maxAttendees,
+                                   'seatShards': conf.seatShards,
+                                   'seatsAvailable': conf.seatsAvailable}
+                mapping[MEMCACHE_SEAT_SNAPSHOT_KEY % wsck] = snapshots[wsck]
+            memcache.add_multi(mapping, time=VERSION_CACHE_TTL)
+            for c_key, count in self._getSeatsAvailableAsync(
+                    confs).get_result().items():
+                seats[c_key.urlsafe()] = count
+
+        forms = []
+        for wsck in wscks:
+            snapshot = snapshots[wsck]
+            if not snapshot:
+                continue
+            forms.append(SeatAvailabilityForm(
+                websafeKey=wsck,
+                seatsAvailable=seats.get(wsck, snapshot['seatsAvailable'])
+                if snapshot['seatShards'] else snapshot['seatsAvailable'],
+                maxAttendees=snapshot['maxAttendees']))
+        return SeatAvailabilityForms(items=forms)
+
+    # Each user's Registration lives under a "home" seat shard picked by
+    # hashing the user id, so a membership check is a key get and claiming
+    # a seat is a single entity group transaction. When the home shard runs
+    # dry, seats are first moved over from the fullest shard.
+    #
+    # Once a registration commits, an Attendance entity is written under
+    # the user's Profile before the call returns, so the user's own list is
+    # a strongly consistent ancestor query. Registering again repairs a
+    # marker that was lost to a failure between the two writes.
+
+    def _getAttendingKeys(self, prof):
+        """Return websafe keys of the conferences a user is registered
+        for, including any not yet migrated off the Profile."""
+        wscks = [key.id() for key in Attendance.query(
+            ancestor=prof.key).fetch(keys_only=True)]
+        return wscks + [wsck for wsck in prof.conferenceKeysToAttend
+                        if wsck not in wscks]
+
+    def _recordAttendance(self, user_ids, wsck, attending=True):
+        """Write (or delete) users' Attendance markers for a conference."""
+        a_keys = [ndb.Key(Profile, user_id, Attendance, wsck)
+                  for user_id in user_ids]
+        if attending:
+            ndb.put_multi([Attendance(key=a_key) for a_key in a_keys])
+        else:
+            ndb.delete_multi(a_keys)
 
-        # check if conf exists given websafeConfKey
-        # get conference; check that it exists
-        wsck = request.inputString
-        conf = ndb.Key(urlsafe=wsck).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % wsck)
+    @transactional('claimSeat')
+    def _claimSeat(self, r_key, c_key, user_id, reg):
+        """Register (or unregister) a user against their home seat shard.
+        Returns None if a registration found the shard empty."""
+        shard, registration = ndb.get_multi([r_key.parent(), r_key])
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registration:
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException("There are no seats available.")
+            # check if the shard has a seat left
+            if shard.seatsAvailable <= 0:
+                return None
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
+            shard.seatsAvailable -= 1
+            ndb.put_multi([shard, Registration(key=r_key, conference=c_key,
+                                               userId=user_id)])
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if not registration:
+                return False
+
+            # unregister user, add back one seat
+            shard.seatsAvailable += 1
+            shard.put()
+            r_key.delete()
+        return True
+
+    @transactional('rebalanceSeats', xg=True)
+    def _rebalanceSeats(self, shardKey, donorKey, wanted=1):
+        """Move seats from a donor shard to an empty one: what is wanted,
+        or half the donor's seats if more. Returns the number moved."""
+        shard, donor = ndb.get_multi([shardKey, donorKey])
+        moved = min(donor.seatsAvailable,
+                    max(wanted, (donor.seatsAvailable + 1) // 2))
+        if moved > 0:
+            donor.seatsAvailable -= moved
+            shard.seatsAvailable += moved
+            ndb.put_multi([shard, donor])
+        return max(moved, 0)
+
+    def _refillShard(self, conf, shardKey, wanted=1):
+        """Refill an empty seat shard from the fullest other shard. Returns
+        whether any seats were moved; False once the conference has no
+        seats left."""
+        donors = [shard for shard in ndb.get_multi(
+            SeatShard.keysFor(conf.key, conf.seatShards), use_cache=False)
+            if shard and shard.key != shardKey and shard.seatsAvailable > 0]
+        if not donors:
+            return False
+        donor = max(donors, key=lambda shard: shard.seatsAvailable)
+        return self._rebalanceSeats(shardKey, donor.key, wanted) > 0
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
+    def _conferenceRegistration(self, request, reg=True):
+        """Register or unregister user for selected conference."""
+        prof = self._getProfileFromUser()  # get user Profile
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        # check if conf exists given websafeConfKey
+        # get conference; check that it exists
+        wsck = request.inputString
+        conf = ndb.Key(urlsafe=wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if not conf.seatShards:
+            conf = self._shardSeats(conf.key)
+        if prof.conferenceKeysToAttend:
+            self._migrateRegistrations(prof.key)
+
+        user_id = prof.key.id()
+        r_key = Registration.keyFor(conf, user_id)
+        try:
+            retval = self._claimSeat(r_key, conf.key, user_id, reg)
+        except ConflictException:
+            # already registered; make sure the marker exists
+            self._recordAttendance([user_id], wsck)
+            raise
+        for _ in range(REFILL_ATTEMPTS):
+            if retval is not None or not self._refillShard(conf,
+                                                           r_key.parent()):
+                break
+            retval = self._claimSeat(r_key, conf.key, user_id, reg)
+        if retval is None:
+            raise ConflictException("There are no seats available.")
+
+        self._recordAttendance([user_id], wsck, attending=reg)
+        if retval:
+            self._seatsChanged(conf.key, -1 if reg else 1)
         return BooleanMessage(data=retval)
 
-    @endpoints.method(message_types.VoidMessage,
+    def _migrateRegistrations(self, p_key):
+        """Move a user's registrations kept on
+        Profile.conferenceKeysToAttend to Registration entities. Seats were
+        already taken, so no shard changes. The Registrations and
+        Attendance markers are written first and the migrated keys are
+        then removed from the Profile in a transaction, so an interrupted
+        run can simply be repeated."""
+        prof = p_key.get()
+        if not prof or not prof.conferenceKeysToAttend:
+            return
+        wscks = list(prof.conferenceKeysToAttend)
+        confs = [conf if conf.seatShards else self._shardSeats(conf.key)
+                 for conf in ndb.get_multi(
+                     [ndb.Key(urlsafe=wsck) for wsck in wscks]) if conf]
+
+        r_keys = [Registration.keyFor(conf, p_key.id()) for conf in confs]
+        ndb.put_multi(
+            [Registration(key=r_key, conference=conf.key, userId=p_key.id())
+             for r_key, conf, registration in zip(
+                 r_keys, confs, ndb.get_multi(r_keys)) if not registration] +
+            [Attendance(parent=p_key, id=conf.key.urlsafe())
+             for conf in confs])
+        self._clearLegacyRegistrations(p_key, wscks)
+
+    @transactional('clearLegacyRegistrations')
+    def _clearLegacyRegistrations(self, p_key, wscks):
+        """Remove migrated keys from a Profile's legacy registration list,
+        keeping any other change made to the Profile meanwhile."""
+        prof = p_key.get()
+        prof.conferenceKeysToAttend = [
+            wsck for wsck in prof.conferenceKeysToAttend if wsck not in wscks]
+        prof.put()
+
+    def _enqueueMigration(self, user_id):
+        """Schedule the migration of one user's legacy registrations; the
+        task name keeps repeated reads from adding it twice."""
+        try:
+            taskqueue.add(
+                name='migrate-registrations-%s' % hashlib.md5(
+                    user_id.encode('utf-8')).hexdigest(),
+                params={'userId': user_id},
+                url='/tasks/migrate_registrations')
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    def _migrateProfiles(self, cursor=None):
+        """Migrate the registrations of a batch of profiles; used by the
+        migration task. Re-enqueues itself with a cursor until done."""
+        profiles, nextCursor, more = Profile.query().fetch_page(
+            MIGRATION_BATCH,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        for prof in profiles:
+            if prof.conferenceKeysToAttend:
+                self._migrateRegistrations(prof.key)
+        if more and nextCursor:
+            taskqueue.add(params={'cursor': nextCursor.urlsafe()},
+                          url='/tasks/migrate_registrations')
+
+    def _seatsChanged(self, c_key, delta):
+        """Apply a committed seat change to the cached aggregate and
+        schedule a fold onto the Conference."""
+        cacheKey = MEMCACHE_SEATS_KEY % c_key.urlsafe()
+        if delta < 0:
+            seats = memcache.decr(cacheKey, -delta)
+        else:
+            seats = memcache.incr(cacheKey, delta)
+        if seats is None:
+            # nobody read the count lately; seed it from the shards, which
+            # already hold this change, so the crossing isn't missed
+            seats = self._seedSeatsAvailable(c_key)
+        if seats is not None:
+            self._seatsCrossedThreshold(c_key, seats, delta)
+        # One fold task per conference per interval; the name dedupes
+        try:
+            taskqueue.add(
+                name='fold-seats-%s-%d' % (c_key.urlsafe(),
+                                           clock.time() // SEAT_FOLD_INTERVAL),
+                params={'conf': c_key.urlsafe()},
+                url='/tasks/fold_seat_counts',
+                countdown=SEAT_FOLD_INTERVAL)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    def _seedSeatsAvailable(self, c_key):
+        """Cache the sum of a Conference's seat shards as its aggregate
+        unless another request cached one first. Returns the sum, or None
+        if the conference is not sharded."""
+        conf = c_key.get()
+        if not conf or not conf.seatShards:
+            return None
+        shards = ndb.get_multi(SeatShard.keysFor(c_key, conf.seatShards),
+                               use_cache=False, use_memcache=False)
+        seats = sum(shard.seatsAvailable for shard in shards if shard)
+        memcache.add(MEMCACHE_SEATS_KEY % c_key.urlsafe(), seats,
+                     time=SEATS_CACHE_TTL)
+        return seats
+
+    @staticmethod
+    @transactional('foldSeatCounts')
+    def _foldSeatCounts(wsck):
+        """Copy the sum of a Conference's seat shards onto its
+        seatsAvailable property; used by the fold task."""
+        conf = ndb.Key(urlsafe=wsck).get()
+        if not conf or not conf.seatShards:
+            return
+        shards = ndb.get_multi(SeatShard.keysFor(conf.key, conf.seatShards),
+                               use_cache=False, use_memcache=False)
+        seats = sum(shard.seatsAvailable for shard in shards if shard)
+        if conf.seatsAvailable != seats:
+            conf.seatsAvailable = seats
+            conf.put()
+
+    @endpoints.method(FIELDS_REQUEST,
                       ConferenceForms,
                       path='conferences/attending',
                       http_method='GET',
                       name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
+        fields = self._checkFieldMask(request.fields, ConferenceForm)
         prof = self._getProfileFromUser()  # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck)
-                     for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId)
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        return self._getConferencesByKeysAsync(
+            self._getAttendingKeys(prof), fields).get_result()
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+    @endpoints.method(ROSTER_REQUEST,
+                      ProfileForms,
+                      path='conference/{inputString}/attendees',
+                      http_method='GET',
+                      name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """Return a page of a conference's attendees (organizer only)."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        conf = ndb.Key(urlsafe=request.inputString).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.inputString)
+        if getUserId(user) != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can see the attendees.')
+
+        # page through the conference's Registrations by key only, then
+        # fetch the page's profiles in one batch
+        request.pageSize = request.pageSize or MAX_PAGE_SIZE
+        q = Registration.query(Registration.conference == conf.key,
+                               default_options=ndb.QueryOptions(
+                                   keys_only=True))
+        r_keys, nextPageToken = self._fetchPage(q, request)
+        profiles = ndb.get_multi(
+            [ndb.Key(Profile, r_key.id()) for r_key in r_keys])
+        return ProfileForms(
+            items=[self._copyProfileToForm(prof, withAttending=False)
+                   for prof in profiles if prof],
+            nextPageToken=nextPageToken)
+
+    @ndb.tasklet
+    def _getConferencesByKeysAsync(self, websafeKeys, fields=None):
+        """Batch-fetch Conferences by websafe key as ConferenceForms,
+        skipping any that no longer exist."""
+        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in websafeKeys]
+        conferences = yield ndb.get_multi_async(conf_keys)
+        forms = yield self._copyConferencesToFormsAsync(
+            [conf for conf in conferences if conf], fields)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[
-            conf.organizerUserId]) for conf in conferences])
+        raise ndb.Return(ConferenceForms(items=forms))
 
-    @endpoints.method(GET_OR_DELETE_REQUEST,
+    @endpoints.method(IDEMPOTENT_REQUEST,
                       BooleanMessage,
                       path='conference/{inputString}',
                       http_method='POST',
                       name='registerForConference')
     def registerForConference(self, request):
         """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        return self._idempotent(request, 'registerForConference',
+                                BooleanMessage,
+                                lambda: self._conferenceRegistration(request))
 
     @endpoints.method(GET_OR_DELETE_REQUEST,
                       BooleanMessage,
@@ -568,6 +1924,363 @@ class ConferenceApi(remote.Service):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
 
+    @transactional('claimGroupSeats', xg=True)
+    def _claimGroupSeats(self, conf, user_ids):
+        """Register a group of users in one transaction over the
+        conference's seat shards, or no one if there are not enough seats.
+        Returns the ids of the users newly registered."""
+        shardKeys = SeatShard.keysFor(conf.key, conf.seatShards)
+        r_keys = [Registration.keyFor(conf, user_id) for user_id in user_ids]
+        entities = ndb.get_multi(shardKeys + r_keys)
+        shards = dict(zip(shardKeys, entities[:len(shardKeys)]))
+        new = [r_key for r_key, registration in
+               zip(r_keys, entities[len(shardKeys):]) if not registration]
+        if sum(shard.seatsAvailable for shard in shards.values()) < len(new):
+            raise ConflictException(
+                "There are not enough seats available for the group.")
+
+        # take each seat from the user's home shard, or from the fullest
+        # shard once that is empty
+        changed = set()
+        for r_key in new:
+            shard = shards[r_key.parent()]
+            if shard.seatsAvailable <= 0:
+                shard = max(shards.values(),
+                            key=lambda shard: shard.seatsAvailable)
+            shard.seatsAvailable -= 1
+            changed.add(shard.key)
+        ndb.put_multi([shards[key] for key in changed] +
+                      [Registration(key=r_key, conference=conf.key,
+                                    userId=r_key.id()) for r_key in new])
+        return [r_key.id() for r_key in new]
+
+    @endpoints.method(GROUP_REGISTRATION_REQUEST,
+                      GroupRegistrationResult,
+                      path='conference/{inputString}/group',
+                      http_method='POST',
+                      name='registerGroupForConference')
+    def registerGroupForConference(self, request):
+        """Register several users for selected conference at once (owner
+        only)."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        wsck = request.inputString
+        conf = ndb.Key(urlsafe=wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if getUserId(user) != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can register a group.')
+
+        user_ids = []
+        for user_id in request.userIds:
+            if user_id not in user_ids:
+                user_ids.append(user_id)
+        if not user_ids or len(user_ids) > MAX_GROUP_SIZE:
+            raise endpoints.BadRequestException(
+                'A group must have between 1 and %d users.' % MAX_GROUP_SIZE)
+
+        profiles = ndb.get_multi([ndb.Key(Profile, user_id)
+                                  for user_id in user_ids])
+        missing = [user_id for user_id, prof in zip(user_ids, profiles)
+                   if not prof]
+        if missing:
+            raise endpoints.NotFoundException(
+                'No profile found for: %s' % ', '.join(missing))
+        for prof in profiles:
+            if prof.conferenceKeysToAttend:
+                self._migrateRegistrations(prof.key)
+        if not conf.seatShards:
+            conf = self._shardSeats(conf.key)
+
+        registered = self._claimGroupSeats(conf, user_ids)
+        self._recordAttendance(user_ids, wsck)
+        if registered:
+            self._seatsChanged(conf.key, -len(registered))
+        return GroupRegistrationResult(
+            registered=registered,
+            alreadyRegistered=[user_id for user_id in user_ids
+                               if user_id not in registered])
+
+    # - - - Queued registration - - - - - - - - - - - - - - - - -
+
+    # For flash sales, registrations can be queued instead: each request
+    # becomes a pull queue task tagged with the conference, and a worker
+    # leases them, groups them by home seat shard and commits up to
+    # REGISTRATION_BATCH at a time in one single-group transaction per
+    # shard, instead of one contended transaction per user.
+
+    def _copyRegistrationToForm(self, req):
+        """Copy relevant fields from RegistrationRequest to
+        RegistrationTicketForm."""
+        return RegistrationTicketForm(
+            ticket=req.key.urlsafe(),
+            websafeConferenceKey=req.websafeConferenceKey,
+            status=getattr(RegistrationStatus, req.status),
+            message=req.message)
+
+    @endpoints.method(GET_OR_DELETE_REQUEST,
+                      RegistrationTicketForm,
+                      path='conference/{inputString}/queue',
+                      http_method='POST',
+                      name='queueRegistrationForConference')
+    def queueRegistrationForConference(self, request):
+        """Queue a registration for the selected conference and return a
+        ticket for getRegistrationStatus()."""
+        prof = self._getProfileFromUser()  # get user Profile
+        wsck = request.inputString
+
+        req = RegistrationRequest(parent=prof.key, websafeConferenceKey=wsck)
+        req.put()
+        taskqueue.Queue(REGISTRATION_QUEUE).add(taskqueue.Task(
+            method='PULL', payload=req.key.urlsafe(), tag=wsck))
+        self._triggerRegistrationWorker(wsck)
+        return self._copyRegistrationToForm(req)
+
+    @endpoints.method(REGISTRATION_STATUS_REQUEST,
+                      RegistrationTicketForm,
+                      path='registration/{ticket}',
+                      http_method='GET',
+                      name='getRegistrationStatus')
+    def getRegistrationStatus(self, request):
+        """Return the state of a queued registration."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        r_key = self._keyFromWebsafe(request.ticket, RegistrationRequest)
+        req = r_key.get() if r_key else None
+        if not req:
+            raise endpoints.NotFoundException(
+                'No registration found with ticket: %s' % request.ticket)
+        if r_key.parent().id() != getUserId(user):
+            raise endpoints.ForbiddenException(
+                'Only the requester can see a registration.')
+        return self._copyRegistrationToForm(req)
+
+    def _triggerRegistrationWorker(self, wsck, named=True):
+        """Schedule the worker for a conference's queued registrations;
+        named tasks coalesce the requests of a short interval."""
+        params = {'params': {'conf': wsck},
+                  'url': '/tasks/process_registrations'}
+        if named:
+            params['name'] = 'process-registrations-%s-%d' % (
+                wsck, clock.time() // REGISTRATION_TRIGGER_INTERVAL)
+            params['countdown'] = REGISTRATION_TRIGGER_INTERVAL
+        try:
+            taskqueue.add(**params)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    def _resolveRegistrations(self, requestKeys, status, message=None):
+        """Mark still-pending queued registrations with a final status."""
+        reqs = [req for req in ndb.get_multi(requestKeys)
+                if req and req.status == 'PENDING']
+        for req in reqs:
+            req.status, req.message = status, message
+        ndb.put_multi(reqs)
+
+    @transactional('commitRegistrationBatch')
+    def _commitRegistrationBatch(self, c_key, r_keys):
+        """Commit queued registrations sharing a home seat shard in a single
+        transaction, in order, until the shard runs out of seats. Returns
+        how many were resolved and how many of those took a seat."""
+        shard = r_keys[0].parent().get()
+        existing = ndb.get_multi(r_keys)
+
+        created = []
+        resolved = 0
+        for r_key, registration in zip(r_keys, existing):
+            # already registered (or committed by an earlier lease)
+            if not registration and r_key not in [r.key for r in created]:
+                if shard.seatsAvailable <= 0:
+                    break
+                # register user, take away one seat
+                shard.seatsAvailable -= 1
+                created.append(Registration(key=r_key, conference=c_key,
+                                            userId=r_key.id()))
+            resolved += 1
+
+        if created:
+            ndb.put_multi(created + [shard])
+        return resolved, len(created)
+
+    def _processRegistrations(self, wsck):
+        """Lease a conference's queued registrations and commit them in
+        batches, one per home seat shard; used by the registration worker
+        task."""
+        queue = taskqueue.Queue(REGISTRATION_QUEUE)
+        tasks = queue.lease_tasks_by_tag(REGISTRATION_LEASE_SECONDS,
+                                         REGISTRATION_LEASE_MAX, tag=wsck)
+        if not tasks:
+            return
+
+        reqs = [req for req in ndb.get_multi(
+            [ndb.Key(urlsafe=task.payload) for task in tasks])
+            if req and req.status == 'PENDING']
+        conf = ndb.Key(urlsafe=wsck).get()
+        if not conf:
+            self._resolveRegistrations(
+                [req.key for req in reqs], 'FAILED',
+                'No conference found with key: %s' % wsck)
+            reqs = []
+        elif not conf.seatShards:
+            conf = self._shardSeats(conf.key)
+
+        # a requester's legacy registrations become Registrations first, so
+        # a seat they already hold is found instead of taken again
+        for prof in ndb.get_multi([req.key.parent() for req in reqs]):
+            if prof and prof.conferenceKeysToAttend:
+                self._migrateRegistrations(prof.key)
+
+        byShard = {}
+        for req in reqs:
+            r_key = Registration.keyFor(conf, req.key.parent().id())
+            byShard.setdefault(r_key.parent(), []).append((r_key, req))
+
+        done, failed = [], []
+        for shardKey, items in byShard.items():
+            while items:
+                batch = items[:REGISTRATION_BATCH]
+                resolved, registered = self._commitRegistrationBatch(
+                    conf.key, [r_key for r_key, req in batch])
+                done.extend(req for r_key, req in batch[:resolved])
+                items = items[resolved:]
+                if registered:
+                    self._seatsChanged(conf.key, -registered)
+                if items and not self._refillShard(
+                        conf, shardKey, min(len(items), REGISTRATION_BATCH)):
+                    failed.extend(req for r_key, req in items)
+                    break
+
+        for req in done:
+            req.status = 'REGISTERED'
+        ndb.put_multi(done)
+        self._recordAttendance([req.key.parent().id() for req in done], wsck)
+        self._resolveRegistrations([req.key for req in failed], 'FAILED',
+                                   "There are no seats available.")
+
+        queue.delete_tasks(tasks)
+        # a full lease may have left more requests behind
+        if len(tasks) == REGISTRATION_LEASE_MAX:
+            self._triggerRegistrationWorker(wsck, named=False)
+
+    # - - - Exports - - - - - - - - - - - - - - - - - - - - - - -
+
+    # Attendee and session exports are written by a task that walks the
+    # query with a cursor, EXPORT_BATCH rows at a time. Each batch is
+    # stored as an ExportChunk in the transaction that advances the
+    # Export's cursor, so a task cut off at its deadline (or retried)
+    # resumes after the last committed batch, and only one batch is held
+    # in memory.
+
+    @staticmethod
+    def _startExports(wsck, fmt='csv'):
+        """Create attendee and session Exports for a conference and enqueue
+        the tasks that write them. Returns the Export keys."""
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError('Unknown export format: %s' % fmt)
+        c_key = ndb.Key(urlsafe=wsck)
+        e_keys = ndb.put_multi([Export(conference=c_key, contents=contents,
+                                       format=fmt)
+                                for contents in sorted(EXPORT_COLUMNS)])
+        for e_key in e_keys:
+            taskqueue.add(params={'export': e_key.urlsafe()},
+                          url='/tasks/export_conference')
+        return e_keys
+
+    @staticmethod
+    def _exportPage(export):
+        """Fetch the batch of an export's rows after its cursor, as dicts of
+        strings. Returns the rows, the next cursor and whether more
+        remain."""
+        start = Cursor(urlsafe=export.cursor) if export.cursor else None
+        if export.contents == 'attendees':
+            q = Registration.query(
+                Registration.conference == export.conference)
+            r_keys, nextCursor, more = q.fetch_page(
+                EXPORT_BATCH, start_cursor=start, keys_only=True)
+            profiles = ndb.get_multi(
+                [ndb.Key(Profile, r_key.id()) for r_key in r_keys])
+            rows = [{'userId': prof.key.id(),
+                     'displayName': prof.displayName,
+                     'mainEmail': prof.mainEmail,
+                     'teeShirtSize': prof.teeShirtSize}
+                    for prof in profiles if prof]
+        else:
+            q = Session.query(ancestor=export.conference)
+            sessions, nextCursor, more = q.fetch_page(EXPORT_BATCH,
+                                                      start_cursor=start)
+            speakerKeys = list(set(sess.speakerKey for sess in sessions
+                                   if sess.speakerKey))
+            speakers = dict((speaker.key, speaker.name) for speaker in
+                            ndb.get_multi(speakerKeys) if speaker)
+            rows = [{'websafeKey': sess.key.urlsafe(),
+                     'name': sess.name,
+                     'speaker': speakers.get(sess.speakerKey),
+                     'typeOfSession': sess.typeOfSession,
+                     'date': sess.date and str(sess.date),
+                     'time': sess.time and sess.time.strftime('%H:%M'),
+                     'duration': sess.duration and str(sess.duration),
+                     'highlights': '; '.join(sess.highlights)}
+                    for sess in sessions]
+        return rows, nextCursor, more
+
+    @staticmethod
+    def _formatExportRows(rows, columns, fmt, header=False):
+        """Serialize rows as CSV or JSONL bytes."""
+        if fmt == 'jsonl':
+            return ''.join(json.dumps(row, sort_keys=True) + '\n'
+                           for row in rows)
+        out = io.BytesIO()
+        writer = csv.writer(out)
+        if header:
+            writer.writerow(columns)
+        for row in rows:
+            writer.writerow([(row[column] or u'').encode('utf-8')
+                             for column in columns])
+        return out.getvalue()
+
+    @staticmethod
+    @transactional('commitExportChunk')
+    def _commitExportChunk(e_key, startCursor, data, nextCursor):
+        """Store a batch as the Export's next chunk and advance its cursor,
+        unless a retried task already committed it. Returns the Export."""
+        export = e_key.get()
+        if export.status != 'RUNNING' or export.cursor != startCursor:
+            return export
+        export.chunks += 1
+        export.cursor = nextCursor
+        if not nextCursor:
+            export.status = 'DONE'
+        ndb.put_multi([ExportChunk(id=export.chunks, parent=e_key, data=data),
+                       export])
+        return export
+
+    @staticmethod
+    def _runExport(urlsafeKey):
+        """Write batches of an export until it is done, re-enqueueing itself
+        before the task deadline; used by the export task."""
+        e_key = ndb.Key(urlsafe=urlsafeKey)
+        export = e_key.get()
+        deadline = clock.time() + EXPORT_TASK_SECONDS
+        while export and export.status == 'RUNNING':
+            if clock.time() > deadline:
+                taskqueue.add(params={'export': urlsafeKey},
+                              url='/tasks/export_conference')
+                return
+            rows, nextCursor, more = ConferenceApi._exportPage(export)
+            data = ConferenceApi._formatExportRows(
+                rows, EXPORT_COLUMNS[export.contents], export.format,
+                header=not export.chunks)
+            export = ConferenceApi._commitExportChunk(
+                e_key, export.cursor, data,
+                nextCursor.urlsafe() if more and nextCursor else None)
+            # keep memory flat: drop the batch from the context cache
+            ndb.get_context().clear_cache()
+
     # ####################################################################### #
     # Session methods                                                         #
     # ####################################################################### #
@@ -576,9 +2289,11 @@ class ConferenceApi(remote.Service):
     # Session creation and retrieval                                          #
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - #
 
-    def _copySessionToForm(self, sess):
+    def _copySessionToForm(self, sess, fields=None):
         sf = SessionForm()
         for field in sf.all_fields():
+            if fields and field.name not in fields:
+                continue
             if field.name == "websafeKey":
                 setattr(sf, field.name, sess.key.urlsafe())
             if hasattr(sess, field.name):
@@ -604,6 +2319,12 @@ class ConferenceApi(remote.Service):
                       name='createSession')
     def createSession(self, request):
         """Create new Session."""
+        return self._idempotent(request, 'createSession', SessionForm,
+                                lambda: self._createSessionObject(request))
+
+    def _createSessionObject(self, request):
+        """Create a Session under the requested conference, returning its
+        SessionForm."""
 
         # get the conference
         conf = ndb.Key(urlsafe=request.inputString).get()
@@ -635,15 +2356,14 @@ class ConferenceApi(remote.Service):
             elif field.name == "speakerKey" and getattr(request, field.name):
                 data[field.name] = ndb.Key(
                     urlsafe=getattr(request, field.name))
-            elif field.name == "inputString" or field.name == "websafeKey":
+            elif field.name in ("inputString", "websafeKey",
+                                "idempotencyKey"):
                 pass
             else:
                 data[field.name] = getattr(request, field.name)
-        p_key = ndb.Key(urlsafe=request.inputString)
-        s_id = Session.allocate_ids(size=1, parent=p_key)[0]
-        s_key = ndb.Key(Session, s_id, parent=p_key)
-        data['key'] = s_key
-        key = Session(**data).put().urlsafe()
+        # the datastore assigns the Session ID under the conference on put
+        sess = Session(parent=conf.key, **data)
+        sess.put()
 
         # Put handling the featured speaker logic on the taskqueue
         if data['speakerKey']:
@@ -651,24 +2371,32 @@ class ConferenceApi(remote.Service):
                                   'conf': conf.key.urlsafe()},
                           url='/tasks/handle_featured_speaker')
 
-        return self._copySessionToForm(ndb.Key(urlsafe=key).get())
+        return self._copySessionToForm(sess)
 
-    @endpoints.method(GET_OR_DELETE_REQUEST,
+    @endpoints.method(SESS_LIST_REQUEST,
                       SessionForms,
                       path='sessions/{inputString}',
                       http_method='GET',
                       name='getConferenceSessions')
     def getConferenceSessions(self, request):
-        """Given a conference, return all sessions."""
-        wsck = request.inputString
-        conf = ndb.Key(urlsafe=wsck).get()
+        """Given a conference, return all sessions, limited to the
+        requested fields if any."""
+        fields = self._checkFieldMask(request.fields, SessionForm)
+        return self._getConferenceSessionsAsync(
+            request.inputString, fields).get_result()
+
+    @ndb.tasklet
+    def _getConferenceSessionsAsync(self, wsck, fields=None):
+        """Check the conference and query its sessions concurrently."""
+        c_key = ndb.Key(urlsafe=wsck)
+        conf, sessionObjects = yield (
+            c_key.get_async(), Session.query(ancestor=c_key).fetch_async())
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
-        sessionObjects = Session.query(ancestor=ndb.Key(urlsafe=wsck))
-        sessionForms = [self._copySessionToForm(sess)
+        sessionForms = [self._copySessionToForm(sess, fields)
                         for sess in sessionObjects]
-        return SessionForms(items=sessionForms)
+        raise ndb.Return(SessionForms(items=sessionForms))
 
     @endpoints.method(GET_OR_DELETE_REQUEST,
                       SessionForms,
@@ -718,14 +2446,18 @@ class ConferenceApi(remote.Service):
         prof = ndb.Key(Profile, user_id).get()
         return prof
 
-    @endpoints.method(GET_OR_DELETE_REQUEST,
+    @endpoints.method(IDEMPOTENT_REQUEST,
                       message_types.VoidMessage,
                       path='wishlist/{inputString}',
                       http_method='POST',
                       name='addSessionToWishlist')
     def addSessionToWishlist(self, request):
         """Add session to user wishlist."""
+        return self._idempotent(request, 'addSessionToWishlist',
+                                message_types.VoidMessage,
+                                lambda: self._addSessionToWishlist(request))
 
+    def _addSessionToWishlist(self, request):
         prof = self._getUserProf()
         sess = ndb.Key(urlsafe=request.inputString).get()
         if not sess:
@@ -764,11 +2496,12 @@ class ConferenceApi(remote.Service):
     def getSessionsInWishlist(self, request):
         """Return all wishlisted sessions for signed-in user."""
         prof = self._getUserProf()
-        
+
         wishlistKeys = getattr(prof, 'userWishlist')
 
-        sessionForms = [self._copySessionToForm(key.get())
-                        for key in wishlistKeys]
+        # one batch get rather than a round trip per session
+        sessionForms = [self._copySessionToForm(sess)
+                        for sess in ndb.get_multi(wishlistKeys) if sess]
         return SessionForms(items=sessionForms)
 
     @endpoints.method(GET_OR_DELETE_REQUEST,
@@ -839,7 +2572,7 @@ class ConferenceApi(remote.Service):
     def getFeaturedSpeaker(self, request):
         """Returns the name of the featured speaker if set else empty
         string."""
-        featured = memcache.get(MEMCACHE_FEATURED_KEY) or ""
+        featured = self._getLocalBanner(MEMCACHE_FEATURED_KEY, "")
         return StringMessage(data=featured)
 
     # ####################################################################### #
@@ -855,11 +2588,13 @@ class ConferenceApi(remote.Service):
         """How would you handle a query for all non-workshop sessions before 7
         pm?"""
 
-        # As suggested here: http://goo.gl/HtsZT2
-        q1 = Session.query(Session.typeOfSession != 'Workshop').fetch(
+        # As suggested here: http://goo.gl/HtsZT2; both keys-only queries
+        # run concurrently
+        f1 = Session.query(Session.typeOfSession != 'Workshop').fetch_async(
             keys_only=True)
-        q2 = Session.query(Session.time < time(19)).fetch(keys_only=True)
-        sessionObjects = ndb.get_multi(set(q1).intersection(q2))
+        f2 = Session.query(Session.time < time(19)).fetch_async(keys_only=True)
+        sessionObjects = ndb.get_multi(
+            set(f1.get_result()).intersection(f2.get_result()))
         sessionForms = [self._copySessionToForm(sess)
                         for sess in sessionObjects]
         return SessionForms(items=sessionForms)
@@ -883,16 +2618,9 @@ class ConferenceApi(remote.Service):
                       name='query_smallConferences')
     def query_smallConferences(self, request):
         """Select only conferences with fewer than 50 maxAttendees."""
-        conferenceObjects = Conference.query(Conference.maxAttendees < 50)
-        conferenceForms = []
-        if conferenceObjects:
-            for conf in conferenceObjects:
-                displayName = None
-                if hasattr(conf.key.parent().get(), 'displayName'):
-                    displayName = getattr(conf.key.parent().get(),
-                                          'displayName')
-                form = self._copyConferenceToForm(conf, displayName)
-                conferenceForms.append(form)
-        return ConferenceForms(items=conferenceForms)
+        conferenceObjects = Conference.query(
+            Conference.isActive == True, Conference.maxAttendees < 50).fetch()
+        return ConferenceForms(
+            items=self._copyConferencesToForms(conferenceObjects))
 
 api = endpoints.api_server([ConferenceApi])  # register API
@@ -14,9 +14,11 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
-from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from models import Export
+from models import ExportChunk
+from models import Profile
 from models import Session
 
 from conference import ConferenceApi
@@ -42,6 +44,98 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                        self.request.get('conferenceInfo'))
 
 
+class ArchiveConferencesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Archive conferences that have ended."""
+        ConferenceApi._archivePastConferences(
+            backfill=bool(self.request.get('backfill')))
+        self.response.set_status(204)
+
+    def post(self):
+        """Continue archiving from a cursor."""
+        ConferenceApi._archivePastConferences(
+            self.request.get('cursor') or None,
+            bool(self.request.get('backfill')))
+
+
+class FoldSeatCountsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy a Conference's sharded seat count onto the Conference."""
+        ConferenceApi._foldSeatCounts(self.request.get('conf'))
+
+
+class ProcessRegistrationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Commit a conference's queued registrations in batches."""
+        ConferenceApi()._processRegistrations(self.request.get('conf'))
+
+
+class MigrateRegistrationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving Profile registrations to Registration entities."""
+        ConferenceApi()._migrateProfiles()
+        self.response.set_status(204)
+
+    def post(self):
+        """Migrate one user, or continue the migration from a cursor."""
+        if self.request.get('userId'):
+            ConferenceApi()._migrateRegistrations(
+                ndb.Key(Profile, self.request.get('userId')))
+        else:
+            ConferenceApi()._migrateProfiles(
+                self.request.get('cursor') or None)
+
+
+class ExportConferenceHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start exporting a conference's attendees and sessions."""
+        e_keys = ConferenceApi._startExports(
+            self.request.get('conf'), self.request.get('format') or 'csv')
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('\n'.join('/exports/%s' % e_key.urlsafe()
+                                       for e_key in e_keys))
+
+    def post(self):
+        """Continue writing an export from its cursor."""
+        ConferenceApi._runExport(self.request.get('export'))
+
+
+class DownloadExportHandler(webapp2.RequestHandler):
+    def get(self, exportKey):
+        """Send a finished export, chunk by chunk."""
+        e_key = ConferenceApi._keyFromWebsafe(exportKey, Export)
+        if not e_key:
+            self.abort(404)
+        export = e_key.get()
+        if not export or export.status != 'DONE':
+            self.abort(404)
+        self.response.headers['Content-Type'] = str(
+            'text/csv' if export.format == 'csv' else 'application/x-ndjson')
+        self.response.headers['Content-Disposition'] = str(
+            'attachment; filename="%s.%s"' % (export.contents, export.format))
+        for chunk in ExportChunk.query(ancestor=e_key).iter(batch_size=10):
+            self.response.write(chunk.data)
+
+
+class PurgeIdempotencyRecordsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete expired idempotency records."""
+        ConferenceApi._purgeIdempotencyRecords()
+        self.response.set_status(204)
+
+    def post(self):
+        """Continue purging from a cursor."""
+        ConferenceApi._purgeIdempotencyRecords(
+            self.request.get('cursor') or None)
+
+
+class UpdateOrganizerDisplayNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy a changed Profile displayName onto the user's Conferences."""
+        ConferenceApi._updateOrganizerDisplayName(
+            self.request.get('userId'), self.request.get('cursor') or None)
+
+
 class HandleFeaturedSpeaker(webapp2.RequestHandler):
     """Perform inquiry to determine and set featured speaker."""
 
@@ -60,13 +154,24 @@ class HandleFeaturedSpeaker(webapp2.RequestHandler):
             sessNames = ", ".join([s.name for s in sess])
             message = "Featured Speaker: {}, presenting {}.".format(
                 speakerKey.get().name, sessNames)
-            memcache.set(MEMCACHE_FEATURED_KEY, message)
+            ConferenceApi._setBanner(MEMCACHE_FEATURED_KEY, message)
 
 
 app = webapp2.WSGIApplication(
     [
         ('/crons/set_announcement', SetAnnouncementHandler),
+        ('/crons/archive_conferences', ArchiveConferencesHandler),
+        ('/crons/purge_idempotency_records', PurgeIdempotencyRecordsHandler),
+        ('/tasks/purge_idempotency_records', PurgeIdempotencyRecordsHandler),
+        ('/tasks/archive_conferences', ArchiveConferencesHandler),
+        ('/tasks/fold_seat_counts', FoldSeatCountsHandler),
+        ('/tasks/process_registrations', ProcessRegistrationsHandler),
+        ('/tasks/migrate_registrations', MigrateRegistrationsHandler),
+        ('/tasks/export_conference', ExportConferenceHandler),
+        ('/exports/(.+)', DownloadExportHandler),
         ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
         ('/tasks/handle_featured_speaker', HandleFeaturedSpeaker),
+        ('/tasks/update_organizer_display_name',
+         UpdateOrganizerDisplayNameHandler),
     ],
     debug=True)
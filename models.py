@@ -11,11 +11,38 @@ created/forked from conferences.py by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import hashlib
 import httplib
+import time
 import endpoints
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+MEMCACHE_CONF_GENERATION_KEY = "CONFERENCE_GENERATION"
+MEMCACHE_CONF_VERSION_KEY = "CONFERENCE_VERSION:%s"
+MEMCACHE_CREATED_KEY = "CONFERENCES_CREATED:%s"
+MEMCACHE_SEAT_SNAPSHOT_KEY = "SEAT_SNAPSHOT:%s"
+INVALIDATION_LOCK_SECONDS = 5
+
+
+def getConferenceGeneration():
+    """Return the current Conference generation, seeding it if evicted.
+
+    The seed is a timestamp so that a counter lost to eviction never comes
+    back at a value that older cache entries were stored under."""
+    generation = memcache.get(MEMCACHE_CONF_GENERATION_KEY)
+    if generation is None:
+        memcache.add(MEMCACHE_CONF_GENERATION_KEY, int(time.time()))
+        generation = memcache.get(MEMCACHE_CONF_GENERATION_KEY)
+    return generation or 0
+
+
+def bumpConferenceGeneration():
+    """Invalidate everything cached under the current Conference
+    generation."""
+    memcache.incr(MEMCACHE_CONF_GENERATION_KEY, initial_value=int(time.time()))
+
 
 class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
@@ -27,7 +54,7 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    conferenceKeysToAttend = ndb.StringProperty(repeated=True)  # legacy
     userWishlist = ndb.KeyProperty(repeated=True)  # Makes more sense as keys.
 
 
@@ -45,6 +72,12 @@ class ProfileForm(messages.Message):
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
 
 
+class ProfileForms(messages.Message):
+    """ProfileForms -- multiple Profile outbound form message"""
+    items = messages.MessageField(ProfileForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
@@ -106,6 +139,151 @@ class Conference(ndb.Model):
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    organizerDisplayName = ndb.StringProperty(indexed=False)  # denormalized
+    version = ndb.IntegerProperty(indexed=False, default=0)  # ETag
+    isActive = ndb.BooleanProperty(default=True)  # False once archived
+    seatShards = ndb.IntegerProperty(indexed=False, default=0)
+
+    def _pre_put_hook(self):
+        # Every write is a new version, so registrations and updates alike
+        # invalidate clients' ETags
+        self.version = (self.version or 0) + 1
+
+    def _post_put_hook(self, future):
+        key = future.get_result()
+
+        def invalidate():
+            bumpConferenceGeneration()
+            # Locking the keys briefly stops a reader that fetched the old
+            # entity from re-adding stale values after this delete
+            memcache.delete_multi(
+                [MEMCACHE_CONF_VERSION_KEY % key.urlsafe(),
+                 MEMCACHE_CREATED_KEY % key.parent().id(),
+                 MEMCACHE_SEAT_SNAPSHOT_KEY % key.urlsafe()],
+                seconds=INVALIDATION_LOCK_SECONDS)
+
+        # Run once the write is visible; outside a transaction this runs now
+        ndb.get_context().call_on_commit(invalidate)
+
+
+class Banner(ndb.Model):
+    """Banner -- last known value of a memcached banner (the announcement
+    or the featured speaker), keyed by its memcache key"""
+    value = ndb.JsonProperty()
+    version = ndb.IntegerProperty(indexed=False, default=0)
+    updated = ndb.DateTimeProperty(indexed=False, auto_now=True)
+
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a Conference's available seats, kept in
+    its own entity group so registrations don't contend on the
+    Conference"""
+    seatsAvailable = ndb.IntegerProperty(indexed=False, default=0)
+
+    @classmethod
+    def keysFor(cls, conf_key, count):
+        """Return the keys of a Conference's seat shards."""
+        return [ndb.Key(cls, '%s:%d' % (conf_key.urlsafe(), i))
+                for i in range(count)]
+
+
+class Registration(ndb.Model):
+    """Registration -- a user's seat at a Conference, keyed by user id
+    under the user's home SeatShard so that claiming the seat and
+    recording it is a single entity group transaction"""
+    conference = ndb.KeyProperty()  # who attends a conference
+    userId = ndb.StringProperty()  # what a user attends
+    created = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+
+    @classmethod
+    def keyFor(cls, conf, user_id):
+        """Return the key of a user's Registration for a sharded
+        Conference."""
+        digest = hashlib.md5(user_id.encode('utf-8')).hexdigest()
+        shardKey = SeatShard.keysFor(conf.key, conf.seatShards)[
+            int(digest, 16) % conf.seatShards]
+        return ndb.Key(cls, user_id, parent=shardKey)
+
+
+class Attendance(ndb.Model):
+    """Attendance -- marks a Conference a user is registered for; a child
+    of the user's Profile with the conference's websafe key as id, so the
+    user's own list is a strongly consistent ancestor query"""
+    created = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+
+
+class RegistrationRequest(ndb.Model):
+    """RegistrationRequest -- queued registration; a child of the user's
+    Profile"""
+    websafeConferenceKey = ndb.StringProperty(indexed=False)
+    status = ndb.StringProperty(indexed=False, default='PENDING')
+    message = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+
+
+class Export(ndb.Model):
+    """Export -- a conference's attendees or sessions as CSV or JSONL,
+    written in ExportChunk batches by the export task"""
+    conference = ndb.KeyProperty()
+    contents = ndb.StringProperty(indexed=False)  # attendees or sessions
+    format = ndb.StringProperty(indexed=False)  # csv or jsonl
+    status = ndb.StringProperty(indexed=False, default='RUNNING')
+    cursor = ndb.StringProperty(indexed=False)  # resume point
+    chunks = ndb.IntegerProperty(indexed=False, default=0)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ExportChunk(ndb.Model):
+    """ExportChunk -- one batch of an Export's rows; a child of the Export
+    with its sequence number as id"""
+    data = ndb.BlobProperty()
+
+
+class IdempotencyRecord(ndb.Model):
+    """IdempotencyRecord -- the stored response of a mutating call, keyed
+    by user, endpoint and the client's idempotency key; cached in memcache
+    by ndb"""
+    _memcache_timeout = 60 * 60
+    response = ndb.TextProperty()  # protojson; None while in progress
+    expires = ndb.DateTimeProperty()
+
+
+class TransactionStatsForm(messages.Message):
+    """TransactionStatsForm -- commit counters of one transaction type"""
+    name = messages.StringField(1)
+    attempts = messages.IntegerField(2)
+    collisions = messages.IntegerField(3)
+    failures = messages.IntegerField(4)
+
+
+class TransactionStatsForms(messages.Message):
+    """TransactionStatsForms -- multiple TransactionStatsForm outbound form
+    message"""
+    items = messages.MessageField(TransactionStatsForm, 1, repeated=True)
+
+
+class GroupRegistrationForm(messages.Message):
+    """GroupRegistrationForm -- users to register for a Conference together"""
+    userIds = messages.StringField(1, repeated=True)
+
+
+class GroupRegistrationResult(messages.Message):
+    """GroupRegistrationResult -- outcome of a group registration"""
+    registered = messages.StringField(1, repeated=True)
+    alreadyRegistered = messages.StringField(2, repeated=True)
+
+
+class SeatAvailabilityForm(messages.Message):
+    """SeatAvailabilityForm -- live seat count of a Conference"""
+    websafeKey = messages.StringField(1)
+    seatsAvailable = messages.IntegerField(2, variant=messages.Variant.INT32)
+    maxAttendees = messages.IntegerField(3, variant=messages.Variant.INT32)
+
+
+class SeatAvailabilityForms(messages.Message):
+    """SeatAvailabilityForms -- multiple SeatAvailabilityForm outbound form
+    message"""
+    items = messages.MessageField(SeatAvailabilityForm, 1, repeated=True)
 
 
 class ConferenceForm(messages.Message):
@@ -122,11 +300,25 @@ class ConferenceForm(messages.Message):
     endDate = messages.StringField(10)  # DateTimeField()
     websafeKey = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag = messages.StringField(13)
+    notModified = messages.BooleanField(14)
 
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class ConferenceResult(messages.Message):
+    """ConferenceResult -- outcome of one item of a batch request"""
+    conference = messages.MessageField(ConferenceForm, 1)
+    error = messages.StringField(2)
+
+
+class ConferenceResults(messages.Message):
+    """ConferenceResults -- per-item outcomes of a batch request"""
+    items = messages.MessageField(ConferenceResult, 1, repeated=True)
 
 
 class TeeShirtSize(messages.Enum):
@@ -148,6 +340,21 @@ class TeeShirtSize(messages.Enum):
     XXXL_W = 15
 
 
+class RegistrationStatus(messages.Enum):
+    """RegistrationStatus -- queued registration state enumeration value"""
+    PENDING = 1
+    REGISTERED = 2
+    FAILED = 3
+
+
+class RegistrationTicketForm(messages.Message):
+    """RegistrationTicketForm -- queued registration outbound form message"""
+    ticket = messages.StringField(1)
+    websafeConferenceKey = messages.StringField(2)
+    status = messages.EnumField('RegistrationStatus', 3)
+    message = messages.StringField(4)
+
+
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
     field = messages.StringField(1)
@@ -158,3 +365,6 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+    fields = messages.StringField(4, repeated=True)
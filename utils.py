@@ -1,11 +1,188 @@
+import collections
+import functools
 import json
 import os
+import random
+import threading
 import time
 import uuid
 
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 from models import Profile
 
+MEMCACHE_TXN_STATS_KEY = "TRANSACTION_STATS:%s:%s"
+TXN_COUNTERS = ('attempts', 'collisions', 'failures')
+TXN_RETRIES = 3
+TXN_BACKOFF = 0.05
+TXN_MAX_BACKOFF = 1.0
+TXN_NAMES = []  # every name passed to transactional(), for the stats
+HOT_KEY_REPLICAS = 8
+
+
+def transactional(name, retries=TXN_RETRIES, xg=False, backoff=TXN_BACKOFF,
+                  maxBackoff=TXN_MAX_BACKOFF):
+    """Decorator running a function in a datastore transaction. Commit
+    collisions are retried up to retries times after a jittered, doubling
+    sleep. Attempts, collisions and final failures are counted in memcache
+    under name. A call made inside a transaction joins it."""
+    if name not in TXN_NAMES:
+        TXN_NAMES.append(name)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwds):
+            if ndb.in_transaction():
+                return fn(*args, **kwds)
+            counts = dict.fromkeys(TXN_COUNTERS, 0)
+            try:
+                for attempt in range(retries + 1):
+                    counts['attempts'] += 1
+                    try:
+                        return ndb.transaction(lambda: fn(*args, **kwds),
+                                               retries=0, xg=xg)
+                    except datastore_errors.TransactionFailedError:
+                        counts['collisions'] += 1
+                        if attempt == retries:
+                            counts['failures'] += 1
+                            raise
+                    time.sleep(random.uniform(
+                        0, min(maxBackoff, backoff * 2 ** attempt)))
+            finally:
+                memcache.offset_multi(
+                    dict((MEMCACHE_TXN_STATS_KEY % (name, counter), n)
+                         for counter, n in counts.items() if n),
+                    initial_value=0)
+        return wrapper
+    return decorator
+
+
+def getTransactionStats():
+    """Return {name: {counter: value}} for every transactional() name."""
+    cached = memcache.get_multi([MEMCACHE_TXN_STATS_KEY % (name, counter)
+                                 for name in TXN_NAMES
+                                 for counter in TXN_COUNTERS])
+    return dict((name, dict(
+        (counter, cached.get(MEMCACHE_TXN_STATS_KEY % (name, counter), 0))
+        for counter in TXN_COUNTERS)) for name in TXN_NAMES)
+
+
+def getOrCompute(key, compute, ttl=0, lease=10, attempts=5, wait=0.05):
+    """Read key from memcache; on a miss, let only one caller at a time
+    (the holder of a memcache lease) run compute() and cache the result.
+    The others wait briefly for it and compute it themselves as a last
+    resort. Results are stored with add() so they respect delete locks."""
+    value = memcache.get(key)
+    if value is not None:
+        return value
+    leaseKey = key + ':lease'
+    for i in range(attempts):
+        if memcache.add(leaseKey, 1, time=lease):
+            try:
+                value = compute()
+                memcache.add(key, value, time=ttl)
+            finally:
+                memcache.delete(leaseKey)
+            return value
+        time.sleep(wait)
+        value = memcache.get(key)
+        if value is not None:
+            return value
+    return compute()
+
+
+class LocalCache(object):
+    """Thread-safe LRU cache with per-key TTLs, kept in the instance's
+    memory and so shared by every request the instance serves. Each
+    entry carries an optional tag, e.g. the version it was read at."""
+
+    def __init__(self, maxsize=100):
+        self._maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return a live entry's value, or None."""
+        entry = self.peek(key)
+        if entry and entry[2] > time.time():
+            return entry[0]
+        return None
+
+    def peek(self, key):
+        """Return (value, tag, expires) for key even if expired, or None;
+        marks the entry as recently used."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, value, ttl, tag=None):
+        """Store value for ttl seconds, evicting the least recently used
+        entry when full."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, tag, time.time() + ttl)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def replicaKeys(key, replicas=HOT_KEY_REPLICAS):
+    """Return the memcache keys holding copies of a hot key."""
+    return ['%s#%d' % (key, i) for i in range(replicas)]
+
+
+def setReplicated(key, value, version, replicas=HOT_KEY_REPLICAS,
+                  attempts=3):
+    """Publish a versioned value to every copy of a hot key. Copies are
+    written with add or compare-and-set, and copies already holding a
+    newer version are left alone, so concurrent writers can't leave an
+    older value behind."""
+    client = memcache.Client()
+    entry = {'version': version, 'value': value}
+    keys = replicaKeys(key, replicas)
+    for _ in range(attempts):
+        current = client.get_multi(keys, for_cas=True)
+        missing = dict((replica, entry) for replica in keys
+                       if replica not in current)
+        stale = dict((replica, entry) for replica, held in current.items()
+                     if held['version'] < version)
+        failed = client.add_multi(missing) if missing else []
+        failed += client.cas_multi(stale) if stale else []
+        if not failed:
+            return
+        keys = failed
+
+
+def getReplicated(key, replicas=HOT_KEY_REPLICAS):
+    """Read a hot key from one of its copies, picked at random, so reads
+    spread over the memcache servers. Returns the {'version', 'value'}
+    entry setReplicated() stored, or None."""
+    return memcache.get('%s#%d' % (key, random.randrange(replicas)))
+
+
+def readThrough(key, regenerate, lastKnown, lease=10, get=memcache.get):
+    """Read key from memcache with get(). On a miss, only the caller
+    holding a memcache lease runs regenerate() to refill it; the others
+    get lastKnown() meanwhile instead of piling onto the regeneration."""
+    value = get(key)
+    if value is not None:
+        return value
+    leaseKey = key + ':lease'
+    if memcache.add(leaseKey, 1, time=lease):
+        try:
+            return regenerate()
+        finally:
+            memcache.delete(leaseKey)
+    return lastKnown()
+
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()